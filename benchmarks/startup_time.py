@@ -0,0 +1,70 @@
+"""
+Cold-start time of each align command.
+
+init and status are run; resolution, rotation and auto need the beamline,
+so the imports they make before the first PV access are timed instead.
+Each command runs in a fresh interpreter; the median of --repeat runs is
+compared with its budget and the script exits with 1 if one is exceeded.
+Run with: python benchmarks/startup_time.py
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# command: (code run in a fresh interpreter, budget in s)
+COMMANDS = {
+    'init':       ("sys.argv = ['align', 'init', '--config', CONFIG]; main()", 0.3),
+    'status':     ("sys.argv = ['align', 'status', '--config', CONFIG]; main()", 0.3),
+    'resolution': ("from align import sample", 1.5),
+    'rotation':   ("from align import sample", 1.5),
+    'auto':       ("from align import auto", 1.5),
+}
+
+TEMPLATE = """
+import sys, time
+start = time.perf_counter()
+from align.__main__ import main
+CONFIG = {config!r}
+{code}
+print(time.perf_counter() - start)
+"""
+
+
+def cold_start(code, home):
+    """Time (s) to import align and run *code* in a fresh interpreter."""
+    env = dict(os.environ, HOME=home, PYTHONPATH=os.pathsep.join([SRC, os.environ.get('PYTHONPATH', '')]))
+    script = TEMPLATE.format(config=os.path.join(home, 'align.conf'), code=code)
+    out = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='runs per command')
+    parser.add_argument('--budget-scale', type=float, default=1.0, help='factor applied to every budget')
+    parser.add_argument('commands', nargs='*', default=list(COMMANDS), help='commands to time')
+    args = parser.parse_args()
+
+    failed = []
+    with tempfile.TemporaryDirectory() as home:
+        for command in args.commands:
+            code, budget = COMMANDS[command]
+            budget *= args.budget_scale
+            median = statistics.median(cold_start(code, home) for _ in range(args.repeat))
+            status = 'ok' if median <= budget else 'SLOW'
+            print('%-12s %7.3f s  (budget %5.2f s)  %s' % (command, median, budget, status))
+            if median > budget:
+                failed.append(command)
+    if failed:
+        print('over budget: %s' % ', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
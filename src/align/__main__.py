@@ -57,8 +57,6 @@ from datetime import datetime
 
 from align import config, __version__
 from align import log
-from align import sample
-from align import auto
 
 
 def init(args):
@@ -71,14 +69,20 @@ def init(args):
 def run_status(args):
     config.show_configs(args)
 
+# sample and auto import pyepics, scipy and skimage: they are imported by
+# the commands that need them, so that init and status start quickly
+
 def run_sample_resolution(args):
+    from align import sample
     sample.adjust('resolution', args)
 
 
 def run_sample_rotation(args):
+    from align import sample
     sample.adjust('center', args)
 
 def run_auto(args):
+    from align import auto
     auto.align_auto(args)
 
 def main():
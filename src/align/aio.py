@@ -0,0 +1,207 @@
+# #########################################################################
+# Copyright (c) 2020, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2019-2020. UChicago Argonne, LLC. This software was produced  #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+"""
+asyncio access to the PVs of pv.init_general_PVs.
+
+The pyepics PV objects are wrapped, not replaced: puts complete and
+monitors fire through pyepics callbacks, which are handed to one event
+loop running in a background thread. Coroutines can be run on that loop
+from synchronous code with submit, which is how the blocking functions
+of align.pv use this layer.
+"""
+
+import time
+import asyncio
+import functools
+import threading
+
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+from epics import ca
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def event_loop():
+    """Process-wide event loop, running in a daemon thread started on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            # blocking pyepics calls of AsyncPV.get run in these threads
+            _loop.set_default_executor(ThreadPoolExecutor(thread_name_prefix='align-aio',
+                                                          initializer=ca.use_initial_context))
+            threading.Thread(target=_run_loop, args=(_loop,), name='align-aio', daemon=True).start()
+        return _loop
+
+
+def _run_loop(loop):
+    # threads sharing the pyepics channels must attach to its CA context
+    ca.use_initial_context()
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def submit(coro):
+    """Schedule *coro* on the event loop; returns a concurrent.futures.Future of its result."""
+    return asyncio.run_coroutine_threadsafe(coro, event_loop())
+
+
+def _resolve(future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+class AsyncPV(object):
+    """Awaitable get, put with completion and monitor stream of a pyepics PV."""
+
+    def __init__(self, pv):
+        self.pv = pv
+
+    @property
+    def pvname(self):
+        return self.pv.pvname
+
+    async def get(self, **kwargs):
+        """Value of the PV; pyepics.PV.get keyword arguments are passed on."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.pv.get, **kwargs))
+
+    async def put(self, value, timeout=None):
+        """Write *value* and wait until the put completes (for a motor, until it stops).
+
+        Raises asyncio.TimeoutError after *timeout* s.
+        """
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        self.pv.put(value, callback=lambda **kwargs: loop.call_soon_threadsafe(_resolve, done, True))
+        await asyncio.wait_for(done, timeout)
+
+    async def monitor(self, as_string=False):
+        """Asynchronous iterator over the values the PV is updated to, as strings if *as_string*."""
+        queue, index = self._subscribe(as_string)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.pv.remove_callback(index)
+
+    async def wait_until(self, condition, timeout=None, as_string=False):
+        """Wait until condition(value) holds for the PV; raises asyncio.TimeoutError after *timeout* s.
+
+        The current value is tested first, then every update of the
+        monitor stream, as a string if *as_string*.
+        """
+        # subscribed before the current value is read, so no update is missed
+        queue, index = self._subscribe(as_string)
+        try:
+            # read on the loop: pyepics monitors scalar PVs and returns the cached value,
+            # and the executor of get is shut down by the time exit handlers wait on PVs
+            current = self.pv.get(as_string=as_string)
+
+            async def reached(current):
+                while not condition(current):
+                    current = await queue.get()
+
+            await asyncio.wait_for(reached(current), timeout)
+        finally:
+            self.pv.remove_callback(index)
+
+    def _subscribe(self, as_string=False):
+        """Queue receiving the PV updates and the pyepics callback index feeding it."""
+        loop = asyncio.get_running_loop()
+
+        def on_change(value=None, char_value=None, **kwargs):
+            if as_string:
+                value = char_value if char_value is not None else str(value)
+            loop.call_soon_threadsafe(queue.put_nowait, value)
+
+        queue = asyncio.Queue()
+        return queue, self.pv.add_callback(on_change)
+
+
+class AsyncPVs(Mapping):
+    """The global_PVs of pv.init_general_PVs as AsyncPV objects, under the same keys."""
+
+    def __init__(self, global_PVs):
+        self._global_PVs = global_PVs
+        self._async = {}
+
+    def __getitem__(self, key):
+        if key not in self._async:
+            self._async[key] = AsyncPV(self._global_PVs[key])
+        return self._async[key]
+
+    def __iter__(self):
+        return iter(self._global_PVs)
+
+    def __len__(self):
+        return len(self._global_PVs)
+
+
+async def move(apv, target, timeout=None):
+    """Move a motor to *target* and return the time it took (s); raises asyncio.TimeoutError after *timeout* s."""
+    start_time = time.time()
+    await apv.put(target, timeout)
+    return time.time() - start_time
+
+
+async def wait_any(waits, timeout=None):
+    """Wait until one of *waits*, (AsyncPV, condition) pairs, holds (see AsyncPV.wait_until).
+
+    Returns False if none holds within *timeout* s.
+    """
+    tasks = [asyncio.ensure_future(apv.wait_until(condition)) for apv, condition in waits]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # the cancelled waits remove their callbacks before returning
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return bool(done)
@@ -10,9 +10,16 @@ Step 1: Camera rotation convergence at Y = 0.
 Step 2: Roll correction at ±Y_ref (operator confirms range and FOV).
 Step 3: Pitch correction at Y_ref (done last — most sensitive axis).
 Step 4: Sample X centering.
+
+With --coarse-binning > 1, iterations of steps 1-3 run on hardware binned
+frames until the step looks converged; that result is then confirmed with
+a full resolution measurement before the step is accepted.
+
+With --subpixel-refiner auto, iterations far from convergence register
+with a cheap sub-pixel refiner; a measurement within threshold is
+re-registered from the same frames at full precision before it is used.
 """
 
-import time
 import numpy as np
 
 from align import log
@@ -21,11 +28,16 @@ from align import pv
 from align import sample
 from align import config
 from align import util
+from align import register
+
+
+# PVs connected by the auto command (see pv.init_general_PVs)
+AUTO_PVS = pv.SHUTTER_PVS + pv.DETECTOR_PVS + pv.SAMPLE_PVS + pv.ROTATION_PVS + pv.ALIGNMENT_PVS
 
 
 def align_auto(params):
 
-    global_PVs = pv.init_general_PVs(params)
+    global_PVs = pv.init_general_PVs(params, AUTO_PVS + (pv.FLY_PVS if params.rotation_motion == 'fly' else ()))
     try:
         detector_sn = global_PVs['Cam1SerialNumber'].get()
         if detector_sn is None or detector_sn == 'Unknown':
@@ -34,6 +46,7 @@ def align_auto(params):
         log.info('*** Detector %s on' % detector_sn)
         detector.init(global_PVs, params)
         detector.set(global_PVs, params)
+        sample._configure_workspaces(params)
         dark_field, white_field = detector.take_dark_and_white(global_PVs, params)
     except KeyError:
         log.error('  *** Some PV assignment failed!')
@@ -49,11 +62,11 @@ def align_auto(params):
     # ── Calibration: camera rotation sensitivity (at Y = 0) ─────────────────
     log.warning('  [auto] calibrating camera rotation sensitivity ...')
     r0 = sample._measure_rotation(params, global_PVs, dark_field, white_field)
-    tilt0 = r0.shift_bottom - r0.shift_top
+    tilt0 = r0.tilt
 
     pv.move_camera_rotation(global_PVs, params, params.calibration_delta_cam)
     r1 = sample._measure_rotation(params, global_PVs, dark_field, white_field)
-    tilt1 = r1.shift_bottom - r1.shift_top
+    tilt1 = r1.tilt
     pv.move_camera_rotation(global_PVs, params, -params.calibration_delta_cam)  # restore
 
     if abs(params.calibration_delta_cam) < 1e-6 or abs(tilt1 - tilt0) < 0.1:
@@ -67,7 +80,7 @@ def align_auto(params):
 
     # ── Calibration: roll and pitch sensitivity (at Y_ref) ───────────────────
     log.warning('  [auto] calibrating roll and pitch sensitivity at Y = %.1f mm ...' % y_ref)
-    pv.move_sample_y(global_PVs, y_ref)
+    _move_y(params, global_PVs, y_ref)
 
     r_base = sample._measure_rotation(params, global_PVs, dark_field, white_field)
 
@@ -97,11 +110,19 @@ def align_auto(params):
     # ── Step 1: Camera rotation (at Y = 0) ───────────────────────────────────
     log.warning('  [auto] === Step 1: Camera rotation convergence ===')
     converged = False
+    binning = params.coarse_binning
+    tilt = None
     for i in range(params.max_iterations):
-        r = sample._measure_rotation(params, global_PVs, dark_field, white_field)
-        tilt = r.shift_bottom - r.shift_top
+        frames, refinement, r = _measure(params, global_PVs, dark_field, white_field, binning, tilt, params.tilt_threshold)
+        if abs(r.tilt) < params.tilt_threshold:
+            r = _full_precision(params, frames, refinement, r)
+        tilt = r.tilt
         log.warning('  [auto] step 1 iter %d: tilt = %+.2f px' % (i + 1, tilt))
         if abs(tilt) < params.tilt_threshold:
+            if binning > 1:
+                _full_resolution(1)
+                binning = 1
+                continue
             log.warning('  [auto] step 1 converged (tilt = %+.2f px < %.1f px)' % (tilt, params.tilt_threshold))
             converged = True
             break
@@ -110,65 +131,100 @@ def align_auto(params):
         log.error('  [auto] step 1 did not converge in %d iterations — aborting' % params.max_iterations)
         return
 
-    # ── Step 2: Roll (at ±Y_ref) ─────────────────────────────────────────────
-    log.warning('  [auto] === Step 2: Roll convergence at Y = ±%.1f mm ===' % y_ref)
-    converged = False
-    for i in range(params.max_iterations):
-        pv.move_sample_y(global_PVs, +y_ref)
-        r_plus = sample._measure_rotation(params, global_PVs, dark_field, white_field)
-
-        pv.move_sample_y(global_PVs, -y_ref)
-        r_minus = sample._measure_rotation(params, global_PVs, dark_field, white_field)
-
-        pv.move_sample_y(global_PVs, 0)
-
-        roll_error = (r_plus.shift_x - r_minus.shift_x) / 2
-        log.warning('  [auto] step 2 iter %d: roll_error = %+.2f px' % (i + 1, roll_error))
-        if abs(roll_error) < params.shift_threshold:
-            log.warning('  [auto] step 2 converged (roll_error = %+.2f px < %.1f px)' % (roll_error, params.shift_threshold))
-            converged = True
-            break
-        pv.move_sample_roll(global_PVs, -roll_error / K_roll)
-    if not converged:
-        log.error('  [auto] step 2 did not converge in %d iterations — aborting' % params.max_iterations)
-        return
-
-    # Re-check camera rotation: roll adjustments can perturb tilt
-    log.warning('  [auto] re-checking camera rotation after roll adjustment ...')
-    r = sample._measure_rotation(params, global_PVs, dark_field, white_field)
-    tilt = r.shift_bottom - r.shift_top
-    if abs(tilt) > params.tilt_threshold:
-        log.warning('  [auto] camera rotation drifted (tilt = %+.2f px) — re-running step 1' % tilt)
+    if sample._multi_angle(params):
+        # ── Steps 2-3: Roll and pitch together (multi-angle mode) ────────────
+        if not _roll_and_pitch(params, global_PVs, dark_field, white_field, y_ref, K_cam, K_roll, K_pitch):
+            return
+    else:
+        # ── Step 2: Roll (at ±Y_ref) ─────────────────────────────────────────
+        log.warning('  [auto] === Step 2: Roll convergence at Y = ±%.1f mm ===' % y_ref)
+        converged = False
+        binning = params.coarse_binning
+        roll_error = None
         for i in range(params.max_iterations):
-            r = sample._measure_rotation(params, global_PVs, dark_field, white_field)
-            tilt = r.shift_bottom - r.shift_top
-            log.warning('  [auto] step 1 re-run iter %d: tilt = %+.2f px' % (i + 1, tilt))
-            if abs(tilt) < params.tilt_threshold:
-                log.warning('  [auto] camera rotation re-converged')
+            # each measurement is registered while sample Y moves on
+            _move_y(params, global_PVs, +y_ref)
+            plus = _start(params, global_PVs, dark_field, white_field, binning, roll_error, params.shift_threshold)
+
+            _move_y(params, global_PVs, -y_ref)
+            minus = _start(params, global_PVs, dark_field, white_field, binning, roll_error, params.shift_threshold)
+
+            motion = pv.start_moves(global_PVs, {'SampleY': 0}, 120.0)
+            frames_plus, refinement, r_plus = _finish(params, global_PVs, dark_field, white_field, plus)
+            frames_minus, refinement, r_minus = _finish(params, global_PVs, dark_field, white_field, minus)
+
+            roll_error = (r_plus.shift_x - r_minus.shift_x) / 2
+            if abs(roll_error) < params.shift_threshold:
+                r_plus = _full_precision(params, frames_plus, refinement, r_plus)
+                r_minus = _full_precision(params, frames_minus, refinement, r_minus)
+                roll_error = (r_plus.shift_x - r_minus.shift_x) / 2
+            log.warning('  [auto] step 2 iter %d: roll_error = %+.2f px' % (i + 1, roll_error))
+            if abs(roll_error) >= params.shift_threshold:
+                # the roll correction travels with the Y return
+                motion.update(pv.start_moves(global_PVs, {'SampleRoll': pv.relative_target(
+                    global_PVs, 'SampleRoll', -roll_error / K_roll)}, 60.0))
+            pv.wait_moves(global_PVs, motion)
+            if abs(roll_error) < params.shift_threshold:
+                if binning > 1:
+                    _full_resolution(2)
+                    binning = 1
+                    continue
+                log.warning('  [auto] step 2 converged (roll_error = %+.2f px < %.1f px)' % (roll_error, params.shift_threshold))
+                converged = True
                 break
-            pv.move_camera_rotation(global_PVs, params, -tilt / K_cam)
-        else:
-            log.error('  [auto] camera rotation re-run did not converge — aborting')
+        if not converged:
+            log.error('  [auto] step 2 did not converge in %d iterations — aborting' % params.max_iterations)
             return
 
-    # ── Step 3: Pitch (at Y_ref) ─────────────────────────────────────────────
-    log.warning('  [auto] === Step 3: Pitch convergence at Y = %.1f mm ===' % y_ref)
-    converged = False
-    for i in range(params.max_iterations):
-        pv.move_sample_y(global_PVs, y_ref)
+        # Re-check camera rotation: roll adjustments can perturb tilt
+        log.warning('  [auto] re-checking camera rotation after roll adjustment ...')
         r = sample._measure_rotation(params, global_PVs, dark_field, white_field)
-        pv.move_sample_y(global_PVs, 0)
-
-        shift_y = r.shift_y
-        log.warning('  [auto] step 3 iter %d: shift_y = %+.2f px' % (i + 1, shift_y))
-        if abs(shift_y) < params.pitch_threshold:
-            log.warning('  [auto] step 3 converged (shift_y = %+.2f px < %.1f px)' % (shift_y, params.pitch_threshold))
-            converged = True
-            break
-        pv.move_sample_pitch(global_PVs, -shift_y / K_pitch)
-    if not converged:
-        log.error('  [auto] step 3 did not converge in %d iterations — aborting' % params.max_iterations)
-        return
+        tilt = r.tilt
+        if abs(tilt) > params.tilt_threshold:
+            log.warning('  [auto] camera rotation drifted (tilt = %+.2f px) — re-running step 1' % tilt)
+            for i in range(params.max_iterations):
+                r = sample._measure_rotation(params, global_PVs, dark_field, white_field)
+                tilt = r.tilt
+                log.warning('  [auto] step 1 re-run iter %d: tilt = %+.2f px' % (i + 1, tilt))
+                if abs(tilt) < params.tilt_threshold:
+                    log.warning('  [auto] camera rotation re-converged')
+                    break
+                pv.move_camera_rotation(global_PVs, params, -tilt / K_cam)
+            else:
+                log.error('  [auto] camera rotation re-run did not converge — aborting')
+                return
+
+        # ── Step 3: Pitch (at Y_ref) ─────────────────────────────────────────
+        log.warning('  [auto] === Step 3: Pitch convergence at Y = %.1f mm ===' % y_ref)
+        converged = False
+        binning = params.coarse_binning
+        shift_y = None
+        for i in range(params.max_iterations):
+            _move_y(params, global_PVs, y_ref)
+            measurement = _start(params, global_PVs, dark_field, white_field, binning, shift_y, params.pitch_threshold)
+            motion = pv.start_moves(global_PVs, {'SampleY': 0}, 120.0)
+            frames, refinement, r = _finish(params, global_PVs, dark_field, white_field, measurement)
+
+            if abs(r.shift_y) < params.pitch_threshold:
+                r = _full_precision(params, frames, refinement, r)
+            shift_y = r.shift_y
+            log.warning('  [auto] step 3 iter %d: shift_y = %+.2f px' % (i + 1, shift_y))
+            if abs(shift_y) >= params.pitch_threshold:
+                # the pitch correction travels with the Y return
+                motion.update(pv.start_moves(global_PVs, {'SamplePitch': pv.relative_target(
+                    global_PVs, 'SamplePitch', -shift_y / K_pitch)}, 60.0))
+            pv.wait_moves(global_PVs, motion)
+            if abs(shift_y) < params.pitch_threshold:
+                if binning > 1:
+                    _full_resolution(3)
+                    binning = 1
+                    continue
+                log.warning('  [auto] step 3 converged (shift_y = %+.2f px < %.1f px)' % (shift_y, params.pitch_threshold))
+                converged = True
+                break
+        if not converged:
+            log.error('  [auto] step 3 did not converge in %d iterations — aborting' % params.max_iterations)
+            return
 
     # ── Step 4: Sample X centering ───────────────────────────────────────────
     log.warning('  [auto] === Step 4: Sample X centering ===')
@@ -176,16 +232,123 @@ def align_auto(params):
     delta_x_mm = -r.shift_center * pixel_size / 1000.0
     log.warning('  [auto] step 4: centering sample X by %+.4f mm (%+.1f px)' % (delta_x_mm, -r.shift_center))
     global_PVs['SampleX'].put(global_PVs['SampleX'].get() + delta_x_mm, wait=True, timeout=600.0)
-    global_PVs['SampleXSet'].put(1, wait=True)
-    time.sleep(.2)
-    global_PVs['SampleX'].put(0, wait=True)
-    time.sleep(.2)
-    global_PVs['SampleXSet'].put(0, wait=True)
+    pv.zero_sample_x(global_PVs)
 
     config.save_sample_params(params)
     log.warning('  [auto] === Alignment complete ===')
 
 
+def _measure(params, global_PVs, dark_field, white_field, binning, residual, threshold):
+    """Rotation measurement registered only as precisely as the next correction needs.
+
+    With --subpixel-refiner auto the refiner is chosen from the *residual*
+    of the previous iteration and the step *threshold*. Returns the
+    frames (a tuple of RotationFrames in multi-angle mode), the
+    refinement used and the RotationResult.
+    """
+    measurement = _start(params, global_PVs, dark_field, white_field, binning, residual, threshold)
+    return _finish(params, global_PVs, dark_field, white_field, measurement)
+
+
+def _start(params, global_PVs, dark_field, white_field, binning, residual, threshold):
+    """Acquire a measurement for _measure and return its sample.Measurement while it is registered."""
+    refinement = register.refinement(residual, threshold) if params.subpixel_refiner == 'auto' else None
+    return sample._start_measurement(params, global_PVs, dark_field, white_field, binning, refinement)
+
+
+def _finish(params, global_PVs, dark_field, white_field, measurement):
+    """Frames, refinement and checked RotationResult of a measurement started by _start."""
+    frames, r = sample._finish_measurement(params, global_PVs, dark_field, white_field, measurement)
+    return frames, measurement.refinement, r
+
+
+def _full_precision(params, frames, refinement, result):
+    """Re-register the frames of a measurement within threshold at full precision."""
+    if refinement is None:
+        return result
+    log.warning('  [auto] within threshold — re-registering the same frames at full precision')
+    if isinstance(frames, sample.RotationFrames):
+        return sample._analyze_rotation(params, frames)
+    return sample._analyze_axis(params, frames)
+
+
+def _full_resolution(step):
+    """Log the switch from coarse binned iterations to the final full resolution measurement."""
+    log.warning('  [auto] step %s within threshold with binned frames — confirming at full resolution' % step)
+
+
+def _roll_and_pitch(params, global_PVs, dark_field, white_field, y_ref, K_cam, K_roll, K_pitch):
+    """Steps 2 and 3 in multi-angle mode, from one ±Y_ref sweep per iteration.
+
+    Each measurement solves center, tilt and pitch together, so every
+    iteration corrects roll from the centers at ±Y_ref and the camera
+    rotation from the tilt; pitch is corrected from shift_y at +Y_ref
+    only once both are within threshold, as in step 3. This replaces the
+    separate pitch sweep and the camera rotation re-check at Y = 0.
+    Returns True when all three converged.
+    """
+    log.warning('  [auto] === Steps 2-3: Roll and pitch convergence at Y = ±%.1f mm (multi-angle) ===' % y_ref)
+    binning = params.coarse_binning
+    roll_error = None
+    shift_y = None
+    for i in range(params.max_iterations):
+        _move_y(params, global_PVs, +y_ref)
+        plus = _start(params, global_PVs, dark_field, white_field, binning, shift_y, params.pitch_threshold)
+
+        _move_y(params, global_PVs, -y_ref)
+        minus = _start(params, global_PVs, dark_field, white_field, binning, roll_error, params.shift_threshold)
+
+        motion = pv.start_moves(global_PVs, {'SampleY': 0}, 120.0)
+        pairs_plus, refinement_plus, r_plus = _finish(params, global_PVs, dark_field, white_field, plus)
+        pairs_minus, refinement_minus, r_minus = _finish(params, global_PVs, dark_field, white_field, minus)
+
+        roll_error, tilt, shift_y = _roll_tilt_pitch(r_plus, r_minus)
+        if _within_thresholds(params, roll_error, tilt, shift_y):
+            r_plus = _full_precision(params, pairs_plus, refinement_plus, r_plus)
+            r_minus = _full_precision(params, pairs_minus, refinement_minus, r_minus)
+            roll_error, tilt, shift_y = _roll_tilt_pitch(r_plus, r_minus)
+        log.warning('  [auto] steps 2-3 iter %d: roll_error = %+.2f px, shift_y = %+.2f px, tilt = %+.2f px'
+                    % (i + 1, roll_error, shift_y, tilt))
+        # the corrections travel with the Y return
+        corrections = {}
+        if abs(tilt) >= params.tilt_threshold:
+            camera_key = pv.camera_rotation_key(global_PVs)
+            corrections[camera_key] = pv.relative_target(global_PVs, camera_key, -tilt / K_cam)
+        if abs(roll_error) >= params.shift_threshold:
+            corrections['SampleRoll'] = pv.relative_target(global_PVs, 'SampleRoll', -roll_error / K_roll)
+        elif abs(tilt) < params.tilt_threshold and abs(shift_y) >= params.pitch_threshold:
+            corrections['SamplePitch'] = pv.relative_target(global_PVs, 'SamplePitch', -shift_y / K_pitch)
+        motion.update(pv.start_moves(global_PVs, corrections, 60.0))
+        pv.wait_moves(global_PVs, motion)
+        if _within_thresholds(params, roll_error, tilt, shift_y):
+            if binning > 1:
+                _full_resolution('2-3')
+                binning = 1
+                continue
+            log.warning('  [auto] steps 2-3 converged (roll_error = %+.2f px, shift_y = %+.2f px, tilt = %+.2f px)'
+                        % (roll_error, shift_y, tilt))
+            return True
+    log.error('  [auto] steps 2-3 did not converge in %d iterations — aborting' % params.max_iterations)
+    return False
+
+
+def _move_y(params, global_PVs, target_mm):
+    """Move sample Y and, at the same time, the rotary stage to the first angle of the next measurement."""
+    started = pv.start_moves(global_PVs, {'SampleY': target_mm}, 120.0)
+    started.update(pv.start_moves(global_PVs, {'Rotation': sample._first_angle(params, global_PVs)}, 600.0))
+    pv.wait_moves(global_PVs, started)
+
+
+def _roll_tilt_pitch(r_plus, r_minus):
+    """Roll error, camera tilt and pitch shift_y from measurements at +Y_ref and -Y_ref."""
+    return (r_plus.shift_x - r_minus.shift_x) / 2, (r_plus.tilt + r_minus.tilt) / 2, r_plus.shift_y
+
+
+def _within_thresholds(params, roll_error, tilt, shift_y):
+    return (abs(roll_error) < params.shift_threshold and abs(tilt) < params.tilt_threshold
+            and abs(shift_y) < params.pitch_threshold)
+
+
 def _confirm_y_ref(params):
     """Prompt operator to confirm Y_ref and that sample is in FOV at both positions."""
     log.warning('  [auto] Roll/pitch steps require moving sample Y to +/-Y_ref.')
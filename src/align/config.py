@@ -52,8 +52,6 @@ import sys
 import argparse
 import configparser
 
-import numpy as np
-
 from collections import OrderedDict
 
 from align import log
@@ -61,6 +59,7 @@ from align import log
 home = os.path.expanduser("~")
 LOGS_HOME = os.path.join(home, 'logs')
 CONFIG_FILE_NAME = os.path.join(home, 'align.conf')
+FLAT_REFERENCE_FILE_NAME = os.path.join(home, 'align_flat_reference.npy')
 
 SECTIONS = OrderedDict()
 
@@ -158,6 +157,10 @@ SECTIONS['epics-pvs'] = {
         'default': '2bmb:m24',
         'type': str,
         'help': 'sample table Y motor pv name (coarse Y, supplements hexapod SampleY)'},
+    'pv-connection-timeout':{
+        'default': 5.0,
+        'type': float,
+        'help': 'time allowed for all the PVs to connect (s); unreachable PVs are reported'},
         }
 
 SECTIONS['shutter'] = {
@@ -192,6 +195,23 @@ SECTIONS['detector'] = {
         'default': None,
         'type': float,
         'help': "Image pixel size (um)"},
+    'num-dark-images': {
+        'default': 10,
+        'type': int,
+        'help': "Number of dark images averaged into the dark field"},
+    'num-white-images': {
+        'default': 10,
+        'type': int,
+        'help': "Number of white images averaged into the white field"},
+    'burst-frames': {
+        'default': 1,
+        'type': int,
+        'help': "Frames taken in one acquisition and reduced to each image of a measurement (step mode); 1 takes a single software triggered frame"},
+    'burst-reduction': {
+        'choices': ['mean', 'median'],
+        'default': 'mean',
+        'type': str,
+        'help': "mean: average of the burst; median: per-pixel median, rejecting zingers present in fewer than half the frames"},
         }
 
 SECTIONS['sample-motion'] = {
@@ -216,6 +236,31 @@ SECTIONS['sample-motion'] = {
         'default': 'horizontal',
         'type': str,
         'help': " "},
+    'sample-out-step': {
+        'default': 1.0,
+        'type': float,
+        'help': "Distance the white field position is moved further out when the sample still shadows the white field (mm)"},
+    'sample-out-max-steps': {
+        'default': 3,
+        'type': int,
+        'help': "Number of times the white field position is moved further out before giving up"},
+    'flat-max-occupancy': {
+        'default': 0.01,
+        'type': float,
+        'help': "Largest fraction of white field pixels allowed below half the open beam background"},
+    'flat-max-nonuniformity': {
+        'default': 0.5,
+        'type': float,
+        'help': "Largest coefficient of variation allowed for the white field divided by the open beam background"},
+    'flat-max-deviation': {
+        'default': 0.02,
+        'type': float,
+        'help': "Largest fraction of white field pixels allowed to differ by more than 10% from the reference flat"},
+    'flat-reference': {
+        'default': FLAT_REFERENCE_FILE_NAME,
+        'type': str,
+        'help': "Reference white field (.npy) the white field is compared with; one file per camera, lens and binning, replaced by every valid white field",
+        'metavar': 'FILE'},
         }
 
 SECTIONS['resolution'] = {
@@ -230,6 +275,10 @@ SECTIONS['tomoscan'] = {
         'default': '2bmb:TomoScan:',
         'type': str,
         'help': ''},
+    'pso-prefix':{
+        'default': '2bmb:PSOFly:',
+        'type': str,
+        'help': 'Prefix of the PSO fly scan records driving the detector trigger in --rotation-motion fly'},
     }
 
 SECTIONS['mctoptics'] = {
@@ -260,6 +309,11 @@ SECTIONS['auto'] = {
         'default': 10,
         'type': int,
         'help': 'Maximum iterations per step before aborting'},
+    'coarse-binning': {
+        'choices': [1, 2, 4],
+        'default': 1,
+        'type': int,
+        'help': 'Detector binning used for the iterations of steps 1-3 until they converge; the converged measurement is always repeated at full resolution. Above 1 the full sensor is read out and the operator ROI and binning are restored at exit'},
     'calibration-delta-cam': {
         'default': 0.05,
         'type': float,
@@ -272,10 +326,77 @@ SECTIONS['auto'] = {
         'default': 0.01,
         'type': float,
         'help': 'Pitch test delta for sensitivity calibration (deg)'},
+    'measurement-angles': {
+        'default': '0,180',
+        'type': str,
+        'help': 'Comma separated rotary stage angles of a rotation measurement (deg), e.g. 0,90,180,270; with more than one pair of angles 180 deg apart the rotation axis is solved by least squares over all pairs and roll and pitch are corrected from the same +/-Y_ref sweep'},
+    'rotation-motion': {
+        'choices': ['step', 'fly'],
+        'default': 'step',
+        'type': str,
+        'help': 'step: stop the rotary stage at each measurement angle and take a software triggered image; fly: rotate through the measurement angles without stopping, at the rotary stage velocity, with the frames triggered by the PSO position compare output'},
+    }
+
+SECTIONS['registration'] = {
+    'registration-mode': {
+        'choices': ['full', 'pyramid'],
+        'default': 'full',
+        'type': str,
+        'help': 'full: register full resolution images; pyramid: estimate the integer shift on binned images, then refine a window at full resolution'},
+    'pyramid-levels': {
+        'default': '8,4',
+        'type': str,
+        'help': 'Comma separated binning factors used in pyramid mode, coarsest first'},
+    'strip-count': {
+        'default': 9,
+        'type': int,
+        'help': 'Number of horizontal strips registered to measure the rotation axis tilt (>= 2)'},
+    'strip-height': {
+        'default': 100,
+        'type': int,
+        'help': 'Height of each horizontal strip (px)'},
+    'pyramid-window': {
+        'default': 512,
+        'type': int,
+        'help': 'Size of the full resolution refinement window used in pyramid mode (px)'},
+    'subpixel-refiner': {
+        'choices': ['auto', 'dft', 'parabolic', 'lk'],
+        'default': 'auto',
+        'type': str,
+        'help': 'Sub-pixel refinement: upsampled DFT (0.01 px), parabolic peak fit, Lucas-Kanade gradient fit; auto: align auto picks the cheapest one that resolves the current error and repeats the converged registration with the DFT at 0.01 px'},
+    'registration-taper': {
+        'choices': ['none', 'hann', 'tukey'],
+        'default': 'none',
+        'type': str,
+        'help': 'Apodization window applied to the images before registration'},
+    'workspace-cache-size': {
+        'default': 2048,
+        'type': int,
+        'help': 'Memory kept for registration buffers reused between measurements (MB); least recently used image shapes are released first'},
+    'memory-budget': {
+        'default': 0,
+        'type': int,
+        'help': 'Upper bound on registration buffers (MB); strips are registered in blocks and full frames coarse-to-fine to stay within it. 0: no limit'},
+    'analysis-workers': {
+        'default': 0,
+        'type': int,
+        'help': 'Number of threads registering and normalizing images; 0: one per CPU core'},
+    'psr-floor': {
+        'default': 10.0,
+        'type': float,
+        'help': 'Lowest phase correlation peak-to-sidelobe ratio accepted before a measurement moves a motor; uncorrelated images stay below about 5 (8 with a hann taper). 0: no check'},
+    'peak-height-floor': {
+        'default': 0.05,
+        'type': float,
+        'help': 'Lowest normalized correlation peak height (0-1) accepted before a measurement moves a motor. 0: no check'},
+    'quality-retries': {
+        'default': 2,
+        'type': int,
+        'help': 'Number of times the lower contrast frame is acquired again when a measurement stays below the quality floors'},
     }
 
-SAMPLE_PARAMS = ('epics-pvs', 'shutter', 'detector', 'sample-motion', 'resolution', 'tomoscan', 'mctoptics', 'auto')
-NICE_NAMES = ('general', 'epics-pvs', 'shutter', 'detector', 'sample-motion', 'resolution', 'tomoscan', 'mctoptics', 'auto')
+SAMPLE_PARAMS = ('epics-pvs', 'shutter', 'detector', 'sample-motion', 'resolution', 'tomoscan', 'mctoptics', 'auto', 'registration')
+NICE_NAMES = ('general', 'epics-pvs', 'shutter', 'detector', 'sample-motion', 'resolution', 'tomoscan', 'mctoptics', 'auto', 'registration')
 AUTO_PARAMS = SAMPLE_PARAMS
 
 
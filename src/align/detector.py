@@ -47,11 +47,17 @@
 Detector lib for areadetector FLIR Oryx cameras.
 """
 
+import os
+import re
 import time
+import atexit
+import threading
 import numpy as np
 
 from align import pv
 from align import log
+from align import util
+from align import config
 
 DetectorIdle = 0
 DetectorAcquire = 1
@@ -63,13 +69,12 @@ def init(global_PVs, params):
         log.info('  *** init FLIR camera')
         log.info('  *** *** set detector to idle')
         global_PVs['Cam1Acquire'].put(DetectorIdle)
-        pv.wait_pv(global_PVs['Cam1Acquire'], DetectorIdle, 2)
+        pv.wait_pv(global_PVs['Cam1AcquireRBV'], DetectorIdle, 2)
         log.info('  *** *** set detector to idle:  Done')
-        time.sleep(0.1) 
         log.info('  *** *** set trigger mode to Off')
         global_PVs['Cam1TriggerMode'].put('Off', wait=True)    # 
+        pv.wait_pv(global_PVs['Cam1TriggerModeRBV'], 'Off', 2)
         log.info('  *** *** set trigger mode to Off: done')
-        time.sleep(0.1) 
         log.info('  *** *** set image mode to single')
         global_PVs['Cam1ImageMode'].put('Single', wait=True)   # here is where it crashes with (ValueError: invalid literal for int() with base 0: 'Single') Added 7 s delay before
         log.info('  *** *** set image mode to single: done')
@@ -78,7 +83,7 @@ def init(global_PVs, params):
         log.info('  *** *** set cam display to 1: done')
         log.info('  *** *** set cam acquire')
         global_PVs['Cam1Acquire'].put(DetectorAcquire)
-        pv.wait_pv(global_PVs['Cam1Acquire'], DetectorAcquire, 2) 
+        pv.wait_pv(global_PVs['Cam1AcquireRBV'], DetectorAcquire, 2) 
         log.info('  *** *** set cam acquire: done')
         log.info('  *** init FLIR camera: Done!')
     else:
@@ -92,7 +97,7 @@ def set(global_PVs, params):
         log.info('  *** setup FLIR camera')
 
         global_PVs['Cam1Acquire'].put(DetectorIdle)
-        pv.wait_pv(global_PVs['Cam1Acquire'], DetectorIdle, 0.5)
+        pv.wait_pv(global_PVs['Cam1AcquireRBV'], DetectorIdle, 0.5)
 
         global_PVs['Cam1TriggerMode'].put('Off', wait=True)
         global_PVs['Cam1TriggerSource'].put('Line2', wait=True)
@@ -107,6 +112,9 @@ def set(global_PVs, params):
         global_PVs['Cam1AcquireTimeAuto'].put('Off')
 
         global_PVs['Cam1AcquireTime'].put(float(params.exposure_time))
+        if params.coarse_binning > 1:
+            # dark and white fields over the full sensor, to be binned for the coarse iterations
+            set_binning(global_PVs, 1)
 
         wait_time_sec = int(params.exposure_time) + 0.5
 
@@ -118,57 +126,406 @@ def set(global_PVs, params):
         return
 
 
-def take_image(global_PVs, params):
+READOUT_PVS = ('Cam1BinX', 'Cam1BinY', 'Cam1MinX', 'Cam1MinY', 'Cam1SizeX', 'Cam1SizeY')
+_operator_readout = None
 
-    log.info('  ***  *** taking a single image')
-   
-    nRow = global_PVs['Cam1SizeY_RBV'].get()
-    nCol = global_PVs['Cam1SizeX_RBV'].get()
 
-    image_size = nRow * nCol
+def set_binning(global_PVs, binning):
+    """Read out the full sensor with binning x binning hardware binning.
+
+    The ROI is reset to the whole sensor so binned frames cover the same
+    field of view as full resolution ones. Only used with --coarse-binning
+    above 1: the operator's ROI and binning are saved on the first call
+    and put back at exit by restore_readout. Nothing is written if the
+    camera is already in the requested mode.
+    """
+    global _operator_readout
+    max_x = global_PVs['Cam1MaxSizeX_RBV'].get()
+    max_y = global_PVs['Cam1MaxSizeY_RBV'].get()
+    if (global_PVs['Cam1BinX'].get() == binning and global_PVs['Cam1BinY'].get() == binning and
+            global_PVs['Cam1MinX'].get() == 0 and global_PVs['Cam1MinY'].get() == 0 and
+            global_PVs['Cam1SizeX'].get() == max_x and global_PVs['Cam1SizeY'].get() == max_y):
+        return
+    if _operator_readout is None:
+        _operator_readout = dict((key, global_PVs[key].get()) for key in READOUT_PVS)
+        atexit.register(restore_readout, global_PVs)
+    log.info('  ***  *** set detector binning to %dx%d over the full sensor' % (binning, binning))
+    global_PVs['Cam1Acquire'].put(DetectorIdle)
+    pv.wait_pv(global_PVs['Cam1AcquireRBV'], DetectorIdle, 2)
+    global_PVs['Cam1MinX'].put(0, wait=True)
+    global_PVs['Cam1MinY'].put(0, wait=True)
+    global_PVs['Cam1SizeX'].put(max_x, wait=True)
+    global_PVs['Cam1SizeY'].put(max_y, wait=True)
+    global_PVs['Cam1BinX'].put(binning, wait=True)
+    global_PVs['Cam1BinY'].put(binning, wait=True)
+
+
+def restore_readout(global_PVs):
+    """Put back the ROI and binning saved by set_binning, if it changed them."""
+    global _operator_readout
+    if _operator_readout is None:
+        return
+    log.info('  ***  *** restore detector binning %dx%d, ROI at (%d, %d) of %d x %d'
+             % tuple(_operator_readout[key] for key in READOUT_PVS))
+    global_PVs['Cam1Acquire'].put(DetectorIdle)
+    pv.wait_pv(global_PVs['Cam1AcquireRBV'], DetectorIdle, 2)
+    for key in READOUT_PVS:
+        global_PVs[key].put(_operator_readout[key], wait=True)
+    _operator_readout = None
+
+
+class AcquisitionSession(object):
+    """Camera kept armed in Multiple mode, each frame fired through Cam1SoftwareTrigger.
+
+    The frame size and pixel format are read once and cached until a
+    monitor of CONFIG_PVS reports a change. The camera is armed again when
+    its acquisition was stopped, e.g. by take_images or set_binning.
+    """
+
+    # PVs the cached frame size and pixel format depend on
+    CONFIG_PVS = ('Cam1ArraySizeX_RBV', 'Cam1ArraySizeY_RBV', 'Cam1PixelFormat_RBV', 'Cam1BinX', 'Cam1BinY')
+    # frames the camera is armed for; it is armed again when they are used up
+    NUM_IMAGES = 10000
+
+    def __init__(self, global_PVs, params):
+        self.global_PVs = global_PVs
+        self.params = params
+        self._config = None
+        self._generation = 0
+        self._armed = False
+        self._callbacks = [(key, global_PVs[key].add_callback(self._invalidate)) for key in self.CONFIG_PVS]
+        self._callbacks.append(('Cam1AcquireRBV', global_PVs['Cam1AcquireRBV'].add_callback(self._acquire_changed)))
+
+    def _invalidate(self, **kwargs):
+        self._generation += 1
+        self._config = None
+
+    def _acquire_changed(self, value=None, **kwargs):
+        if value == DetectorIdle:
+            self._armed = False
+
+    def _configuration(self):
+        """Cached (rows, columns, pixel format) of the frames."""
+        config = self._config
+        if config is None:
+            generation = self._generation
+            config = (self.global_PVs['Cam1ArraySizeY_RBV'].get(), self.global_PVs['Cam1ArraySizeX_RBV'].get(),
+                      self.global_PVs['Cam1PixelFormat_RBV'].get(as_string=True))
+            # not cached if it changed while it was read
+            if generation == self._generation:
+                self._config = config
+        return config
+
+    def arm(self):
+        """Start a Multiple mode acquisition waiting for software triggers."""
+        log.info('  ***  *** arming the detector for software triggers')
+        self.global_PVs['Cam1Acquire'].put(DetectorIdle)
+        pv.wait_pv(self.global_PVs['Cam1AcquireRBV'], DetectorIdle, 2)
+        self.global_PVs['Cam1ImageMode'].put('Multiple', wait=True)
+        self.global_PVs['Cam1NumImages'].put(self.NUM_IMAGES, wait=True)
+        self.global_PVs['Cam1TriggerSource'].put('Software', wait=True)
+        self.global_PVs['Cam1TriggerMode'].put('On', wait=True)
+        self.global_PVs['Cam1Acquire'].put(DetectorAcquire)
+        pv.wait_pv(self.global_PVs['Cam1AcquireRBV'], DetectorAcquire, 2)
+        self._armed = True
+
+    def take_image(self):
+        """Trigger one frame and return it as uint16."""
+        log.info('  ***  *** taking a single image')
+        if not self._armed:
+            self.arm()
+        nRow, nCol, pixel_format = self._configuration()
+        wait_time_sec = self.params.exposure_time + 5
+
+        counter = self.global_PVs['ImageCounter'].get()
+        self.global_PVs['Cam1SoftwareTrigger'].put(1)
+        # the image plugin has received the new frame, even if the counter advanced by more than one
+        if not pv.wait_until(self.global_PVs['ImageCounter'], lambda value: value > counter,
+                             wait_time_sec):
+            self.global_PVs['Cam1Acquire'].put(DetectorIdle)
+            raise RuntimeError('  ***  *** no frame %.1f s after the software trigger' % wait_time_sec)
+
+        return _read_image(self.global_PVs, nRow, nCol, pixel_format)
+
+    def close(self):
+        """Stop the acquisition and return to Line2 triggers (see set)."""
+        for key, index in self._callbacks:
+            self.global_PVs[key].remove_callback(index)
+        self._callbacks = []
+        if self._armed:
+            self.global_PVs['Cam1Acquire'].put(DetectorIdle)
+            pv.wait_pv(self.global_PVs['Cam1AcquireRBV'], DetectorIdle, 2)
+            self._armed = False
+        self.global_PVs['Cam1TriggerSource'].put('Line2', wait=True)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def session(global_PVs, params):
+    """The AcquisitionSession of the process, created on first use and closed at exit."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = AcquisitionSession(global_PVs, params)
+            atexit.register(_session.close)
+        return _session
+
+
+def take_image(global_PVs, params, num_frames=None, reduction=None):
+    """One frame as uint16, taken by the AcquisitionSession.
+
+    With num_frames (default params.burst_frames) above 1, a burst of that
+    many frames reduced to one float32 image instead (see take_burst).
+    """
+    num_frames = params.burst_frames if num_frames is None else num_frames
+    if num_frames > 1:
+        return take_burst(global_PVs, params, num_frames, params.burst_reduction if reduction is None else reduction)
+    return session(global_PVs, params).take_image()
+
+
+def take_burst(global_PVs, params, num_frames, reduction='mean'):
+    """Burst of *num_frames* frames taken in one Acquire, reduced to a float32 image.
+
+    Each frame is accumulated as it is read out (see take_images) into a
+    buffer allocated once per burst. reduction is 'mean', or 'median',
+    which rejects zingers present in fewer than half of the frames; hot
+    pixels are in every frame and are left to the dark subtraction. Frames overwritten before they could be read are left out.
+    """
+    log.info('  ***  *** taking the %s of a burst of %d images' % (reduction, num_frames))
+    count = 0
+    for image in take_images(global_PVs, params, num_frames):
+        if count == 0:
+            if reduction == 'median':
+                buffer = np.empty((num_frames,) + image.shape, dtype=image.dtype)
+            else:
+                buffer = np.zeros(image.shape, dtype=np.float32)
+        if reduction == 'median':
+            buffer[count] = image
+        else:
+            np.add(buffer, image, out=buffer)
+        count += 1
+    if count == 0:
+        raise RuntimeError('  *** no image could be read from the detector')
+
+    if reduction == 'median':
+        return np.median(buffer[:count], axis=0, overwrite_input=True).astype(np.float32)
+    return np.divide(buffer, np.float32(count), out=buffer)
+
+
+def take_images(global_PVs, params, num_images, start=None, timeout=None):
+    """Acquire *num_images* frames in Multiple image mode, yielding each one as it is read out.
+
+    A frame is read each time the image plugin array counter advances;
+    frames overwritten before they could be read are reported and
+    skipped, so fewer than *num_images* frames may be yielded.
 
-    global_PVs['Cam1NumImages'].put(1, wait=True)
+    With *start*, the camera is armed in hardware trigger mode (see set)
+    and start() is called to produce the triggers, e.g. pv.fly. *timeout*
+    bounds the wait for each frame (s), by default the exposure time + 5 s.
+    """
+    log.info('  ***  *** taking %d images' % num_images)
 
-    global_PVs['Cam1TriggerMode'].put('Off', wait=True)
-    wait_time_sec = int(params.exposure_time) + 5
+    nRow = global_PVs['Cam1ArraySizeY_RBV'].get()
+    nCol = global_PVs['Cam1ArraySizeX_RBV'].get()
 
-    global_PVs['Cam1Acquire'].put(DetectorAcquire, wait=True, timeout=1000.0)
-    time.sleep(0.1)
-    if pv.wait_pv(global_PVs['Cam1Acquire'], DetectorIdle, wait_time_sec) == False: # adjust wait time
+    # stops an armed AcquisitionSession, which arms the camera again when it is next used
+    if global_PVs['Cam1AcquireRBV'].get() != DetectorIdle:
         global_PVs['Cam1Acquire'].put(DetectorIdle)
-    
+        pv.wait_pv(global_PVs['Cam1AcquireRBV'], DetectorIdle, 2)
+    global_PVs['Cam1ImageMode'].put('Multiple', wait=True)
+    global_PVs['Cam1NumImages'].put(num_images, wait=True)
+    if start is not None:
+        global_PVs['Cam1TriggerSource'].put('Line2', wait=True)
+    global_PVs['Cam1TriggerMode'].put('Off' if start is None else 'On', wait=True)
+    wait_time_sec = params.exposure_time + 5 if timeout is None else timeout
+
+    counter = global_PVs['ImageCounter'].get()
+    global_PVs['Cam1Acquire'].put(DetectorAcquire)
+    if start is not None:
+        pv.wait_pv(global_PVs['Cam1AcquireRBV'], DetectorAcquire, 2)
+        start()
+    read = 0
+    missed = 0
+    while read + missed < num_images:
+        last = counter
+        # the counter advances, or the acquisition stops
+        pv.wait_any(((global_PVs['ImageCounter'], lambda value, last=last: value != last),
+                     (global_PVs['Cam1AcquireRBV'], lambda value: value == DetectorIdle)), wait_time_sec)
+        counter = global_PVs['ImageCounter'].get()
+        if counter == last:
+            log.error('  ***  *** acquisition stopped after %d of %d images' % (read + missed, num_images))
+            break
+        missed += counter - last - 1
+        read += 1
+        yield _read_image(global_PVs, nRow, nCol)
+
+    if missed:
+        log.warning('  ***  *** %d of %d images were overwritten before they could be read' % (missed, num_images))
+    global_PVs['Cam1Acquire'].put(DetectorIdle)
+    pv.wait_pv(global_PVs['Cam1AcquireRBV'], DetectorIdle, 2)
+
+
+def take_average(global_PVs, params, num_images):
+    """Per-pixel mean and variance of *num_images* frames as a util.RunningStatistics."""
+    stats = None
+    for image in take_images(global_PVs, params, num_images):
+        if stats is None:
+            stats = util.RunningStatistics(image.shape)
+        stats.add(image)
+    if stats is None:
+        raise RuntimeError('  *** no image could be read from the detector')
+    return stats
+
+
+# pixel formats sent one pixel per array element
+PIXEL_FORMATS = ('Mono8', 'Mono10', 'Mono12', 'Mono14', 'Mono16')
+
+
+def _unpack_mono12packed(packed, out):
+    """GigE Vision Mono12Packed: byte 0 is pixel 0 bits 11-4, byte 1 holds bits 3-0 of pixel 0
+    (low nibble) and pixel 1 (high nibble), byte 2 is pixel 1 bits 11-4."""
+    even, odd = out[:, 0], out[:, 1]
+    np.left_shift(packed[:, 0], 4, out=even, dtype=np.uint16)
+    np.bitwise_or(even, packed[:, 1] & 0x0F, out=even)
+    np.left_shift(packed[:, 2], 4, out=odd, dtype=np.uint16)
+    np.bitwise_or(odd, packed[:, 1] >> 4, out=odd)
+
+
+def _unpack_mono12p(packed, out):
+    """GenICam Mono12p: the 24 bits of two pixels, least significant bit first."""
+    even, odd = out[:, 0], out[:, 1]
+    np.left_shift(packed[:, 1] & 0x0F, 8, out=even, dtype=np.uint16)
+    np.bitwise_or(even, packed[:, 0], out=even)
+    np.left_shift(packed[:, 2], 4, out=odd, dtype=np.uint16)
+    np.bitwise_or(odd, packed[:, 1] >> 4, out=odd)
+
+
+# 12-bit formats sent as 3 bytes per 2 pixels, when the driver does not unpack them
+PACKED_FORMATS = {'Mono12Packed': _unpack_mono12packed, 'Mono12p': _unpack_mono12p}
+
+
+def _is_packed(global_PVs, pixelFormat):
+    """True if the image plugin array holds pixelFormat packed, as bytes."""
+    return pixelFormat in PACKED_FORMATS and 'char' in str(global_PVs['Image'].type)
+
+
+def decode_image(raw, nRow, nCol, pixelFormat, packed=False):
+    """nRow x nCol frame from the image plugin array *raw*.
+
+    With one pixel per element the unsigned view of raw is returned
+    without a copy (uint8 for a byte array, uint16 for a short array), as
+    the CA arrays are signed. Packed 12-bit formats are unpacked to uint16
+    in one pass.
+    """
+    image_size = nRow * nCol
+    if packed:
+        out = np.empty((image_size // 2, 2), dtype=np.uint16)
+        PACKED_FORMATS[pixelFormat](raw.view(np.uint8)[:image_size * 3 // 2].reshape(-1, 3), out)
+        return out.reshape(nRow, nCol)
+    if pixelFormat not in PIXEL_FORMATS and pixelFormat not in PACKED_FORMATS:
+        raise RuntimeError('  ***  *** pixel format %s not supported' % pixelFormat)
+    return raw[:image_size].view(np.dtype('u%d' % raw.itemsize)).reshape(nRow, nCol)
+
+
+def _read_image(global_PVs, nRow, nCol, pixelFormat=None):
+    """Image currently held by the image plugin, unsigned (see decode_image)."""
+
+    if pixelFormat is None:
+        pixelFormat = global_PVs['Cam1PixelFormat_RBV'].get(as_string=True)
+    packed = _is_packed(global_PVs, pixelFormat)
+    image_size = nRow * nCol * 3 // 2 if packed else nRow * nCol
+
     # Get the image loaded in memory
     img_vect = global_PVs['Image'].get(count=image_size)
-    img = np.reshape(img_vect,[nRow, nCol])
 
-    pixelFormat = global_PVs['Cam1PixelFormat_RBV'].get(as_string=True)
-    if (pixelFormat == "Mono16"):
-        pixel_f = 16
-    elif (pixelFormat == "Mono8"):
-        pixel_f = 8
-    else:
-        log.error('  ***  *** bit %s format not supported' % pixelFormat)
-        exit()
-    img_uint = np.mod(img.astype('int32'), 2**pixel_f).astype('uint16')    
+    return decode_image(img_vect, nRow, nCol, pixelFormat, packed)
+
 
-    return img_uint
+def _report_noise(name, stats):
+    """Log the per-pixel noise of an averaged field."""
+    if stats.count < 2:
+        log.info('  ***  *** %s field: 1 image, no noise estimate' % name)
+        return
+    std = stats.std
+    median = float(np.median(std[::4, ::4]))
+    noisy = int(np.count_nonzero(std > 5 * median)) if median > 0 else 0
+    log.info('  ***  *** %s field: %d images, per-pixel noise median %.2f, 99th percentile %.2f counts, '
+             '%d pixels above 5x median; noise of the average %.2f counts'
+             % (name, stats.count, median, float(np.percentile(std[::4, ::4], 99)), noisy,
+                median / np.sqrt(stats.count)))
 
 
 def take_dark_and_white(global_PVs, params):
     pv.close_shutters(global_PVs, params)
     log.info('  ***  *** acquire dark')
-    dark_field = take_image(global_PVs, params)
+    dark = take_average(global_PVs, params, params.num_dark_images)
+    _report_noise('dark', dark)
+    dark_field = dark.mean
     # plot(dark_field)
 
     pv.open_shutters(global_PVs, params)
-    pv.move_sample_out(global_PVs, params)
-    log.info('  ***  *** acquire white')
-    white_field = take_image(global_PVs, params)
-    # plot(white_field)
+    reference_file = _flat_reference_file(global_PVs, params)
+    reference = _load_flat_reference(reference_file)
+    for step in range(params.sample_out_max_steps + 1):
+        pv.move_sample_out(global_PVs, params)
+        log.info('  ***  *** acquire white')
+        white = take_average(global_PVs, params, params.num_white_images)
+        white_field = white.mean
+        # plot(white_field)
+        check = util.check_flat_field(white_field, dark_field, reference, params.flat_max_occupancy,
+                                      params.flat_max_nonuniformity, params.flat_max_deviation)
+        log.info('  ***  *** white field occupancy %.4f, nonuniformity %.3f, reference deviation %s'
+                 % (check.occupancy, check.nonuniformity,
+                    'n/a' if check.deviation is None else '%.4f' % check.deviation))
+        if check.valid:
+            _report_noise('white', white)
+            break
+        if check.occupancy <= params.flat_max_occupancy and check.nonuniformity <= params.flat_max_nonuniformity:
+            log.warning('  ***  *** white field shows no sample but differs from the reference: '
+                        'the beam changed since the reference was saved')
+            _report_noise('white', white)
+            break
+        if step == params.sample_out_max_steps:
+            pv.move_sample_in(global_PVs, params)
+            raise RuntimeError('  *** white field is not clean after moving the sample out %d more times: '
+                               'check sample-out-x/y and the beam' % params.sample_out_max_steps)
+        log.warning('  ***  *** sample is not clear of the beam in the white field: moving it further out')
+        pv.step_sample_out(params)
+
+    if step > 0:
+        log.warning('  ***  *** white field clean at sample out X %f mm, Y %f mm: saved to %s'
+                    % (params.sample_out_x, params.sample_out_y, params.config))
+        config.save_sample_params(params)
+    _save_flat_reference(reference_file, white_field, dark_field)
 
     pv.move_sample_in(global_PVs, params)
 
     return dark_field, white_field
 
 
+def _flat_reference_file(global_PVs, params):
+    """The flat-reference file of the current camera, lens and binning.
+
+    A reference is only comparable with white fields taken through the
+    same optics, so each combination keeps its own file next to
+    --flat-reference.
+    """
+    root, ext = os.path.splitext(params.flat_reference)
+    key = '%s_%s_bin%d' % (params.detector_prefix, global_PVs['LensSelect'].get(as_string=True),
+                           global_PVs['Cam1BinX'].get())
+    return '%s_%s%s' % (root, re.sub(r'\W+', '', key), ext or '.npy')
+
+
+def _load_flat_reference(file_name):
+    """Reference dark subtracted white field, or None if none was saved yet."""
+    if not os.path.exists(file_name):
+        return None
+    return np.load(file_name)
+
 
+def _save_flat_reference(file_name, white_field, dark_field):
+    """Replace the reference with the last white field shown to be clean."""
+    log.info('  ***  *** saving reference white field to %s' % file_name)
+    np.save(file_name, np.subtract(white_field, dark_field, dtype=np.float32))
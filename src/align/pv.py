@@ -48,135 +48,261 @@ Epics PV definitions
 """
 
 import time
+import asyncio
+import threading
+import concurrent.futures
 
 from epics import PV
 from align import log
+from align import aio
 
 EPSILON = 0.1
 
 
-def wait_pv(pv, wait_val, max_timeout_sec=-1):
-
-    # wait on a pv to be a value until max_timeout (default forever)   
-    # delay for pv to change
-    time.sleep(.01)
-    startTime = time.time()
-    while(True):
-        pv_val = pv.get()
-        if type(pv_val) == float:
-            if abs(pv_val - wait_val) < EPSILON:
-                return True
-        if (pv_val != wait_val):
-            if max_timeout_sec > -1:
-                curTime = time.time()
-                diffTime = curTime - startTime
-                if diffTime >= max_timeout_sec:
-                    log.error('  *** ERROR: DROPPED IMAGES ***')
-                    log.error('  *** wait_pv(%s, %d, %5.2f reached max timeout. Return False' % (pv.pvname, wait_val, max_timeout_sec))
-
-
-                    return False
-            time.sleep(.01)
+def wait_pv(pv, wait_val, max_timeout_sec=-1, tolerance=EPSILON):
+    """Wait for a PV to be wait_val, up to max_timeout_sec (default forever).
+
+    Floats match within tolerance; a string wait_val is compared with the
+    string value of the PV (e.g. an enum). The wait runs on the monitor
+    stream of the PV (see wait_until) and returns as soon as the value
+    arrives. Returns False if the timeout is reached.
+    """
+    def matches(value):
+        if isinstance(value, float) and not isinstance(wait_val, str):
+            return abs(value - wait_val) < tolerance
+        return value == wait_val
+
+    if wait_until(pv, matches, max_timeout_sec, as_string=isinstance(wait_val, str)):
+        return True
+    log.error('  *** ERROR: DROPPED IMAGES ***')
+    log.error('  *** wait_pv(%s, %s, %5.2f reached max timeout. Return False' % (pv.pvname, wait_val, max_timeout_sec))
+    return False
+
+
+def wait_until(pv, condition, max_timeout_sec=-1, as_string=False):
+    """Wait for condition(value) to hold for a PV, up to max_timeout_sec (default forever).
+
+    Runs aio.AsyncPV.wait_until on the event loop of align.aio; the value
+    is a string if *as_string*. Returns False if the timeout is reached.
+    """
+    timeout = None if max_timeout_sec < 0 else max_timeout_sec
+    try:
+        aio.submit(aio.AsyncPV(pv).wait_until(condition, timeout, as_string)).result()
+        return True
+    except (asyncio.TimeoutError, concurrent.futures.TimeoutError):
+        return False
+
+
+def wait_any(waits, max_timeout_sec=-1):
+    """Wait until condition(value) holds for one of *waits*, (pv, condition) pairs (see aio.wait_any).
+
+    Returns False if none holds within max_timeout_sec (default forever).
+    """
+    timeout = None if max_timeout_sec < 0 else max_timeout_sec
+    return aio.submit(aio.wait_any([(aio.AsyncPV(pv), condition) for pv, condition in waits], timeout)).result()
+
+_registry = {}
+_registry_lock = threading.Lock()
+_created = {}
+_connected = {}
+_reported = set()
+
+
+def _pv(pvname):
+    """The PV of *pvname*, created once per process.
+
+    Creating the PV only starts the connection, so the channels of
+    init_general_PVs connect in parallel.
+    """
+    with _registry_lock:
+        if pvname not in _registry:
+            _created[pvname] = time.time()
+            _registry[pvname] = PV(pvname, connection_callback=_on_connection)
+        return _registry[pvname]
+
+
+def _on_connection(pvname=None, conn=None, **kwargs):
+    if conn and pvname not in _connected:
+        _connected[pvname] = time.time()
+
+
+def connect(pvs, timeout):
+    """Wait, up to *timeout* s in total, for the channels of *pvs* to connect.
+
+    Channels of the registry are reported once per process: the slowest
+    connection time and the unreachable channels. Returns the names of the
+    unreachable channels.
+    """
+    deadline = time.time() + timeout
+    unreachable = []
+    for pv in pvs:
+        if pv.pvname in _reported:
+            # already waited for once: do not wait again
+            connected = pv.connected
         else:
-            return True
-
-def init_general_PVs(params):
-
-    global_PVs = {}
-
-    global_PVs['ShutterOpen']               = PV(params.shutter_open_pv_name  + '.VAL')
-    global_PVs['ShutterClose']              = PV(params.shutter_close_pv_name + '.VAL')
-    global_PVs['ShutterStatus']             = PV(params.shutter_status_pv_name + '.VAL')    
-    global_PVs['SampleX']                   = PV(params.sample_x_pv_name + '.VAL')
-    global_PVs['SampleXSet']                = PV(params.sample_x_pv_name + '.SET')
-    global_PVs['SampleY']                   = PV(params.sample_y_pv_name + '.VAL')
-    global_PVs['SampleYSet']                = PV(params.sample_y_pv_name + '.SET')   
-    global_PVs['SampleTheta']               = PV(params.sample_theta_pv_name + '.VAL')
-    global_PVs['Rotation']                  = PV(params.rotation_pv_name + '.VAL') 
-    global_PVs['RotationRBV']               = PV(params.rotation_pv_name + '.RBV')
-    global_PVs['RotationCnen']              = PV(params.rotation_pv_name + '.CNEN') 
-    global_PVs['RotationAccl']              = PV(params.rotation_pv_name + '.ACCL') 
-    global_PVs['RotationStop']              = PV(params.rotation_pv_name + '.STOP') 
-    global_PVs['RotationSet']               = PV(params.rotation_pv_name + '.SET') 
-    global_PVs['RotationVelo']              = PV(params.rotation_pv_name + '.VELO')   
-    global_PVs['SampleXTop']                = PV(params.sample_x_top_pv_name + '.VAL')
-    global_PVs['SampleZTop']                = PV(params.sample_z_top_pv_name + '.VAL') 
-    global_PVs['SamplePitch']               = PV(params.sample_pitch_pv_name + '.VAL')
-    global_PVs['SampleRoll']                = PV(params.sample_roll_pv_name + '.VAL')
-    global_PVs['SampleLamino']              = PV(params.sample_lamino_pv_name + '.VAL')
-    global_PVs['SampleTableY']              = PV(params.sample_table_y_pv_name + '.VAL')
-    global_PVs['LensSelect']                = PV(params.mctoptics_prefix + 'LensSelect')
-    global_PVs['LensName0']                 = PV(params.mctoptics_prefix + 'Lens0Name')
-    global_PVs['LensName1']                 = PV(params.mctoptics_prefix + 'Lens1Name')
-    global_PVs['LensName2']                 = PV(params.mctoptics_prefix + 'Lens2Name')
-    global_PVs['FocusLens1']                = PV(params.focus_lens_1_pv_name + '.VAL')
-    global_PVs['FocusLens2']                = PV(params.focus_lens_2_pv_name + '.VAL')
-    global_PVs['FocusLens3']                = PV(params.focus_lens_3_pv_name + '.VAL')
+            connected = pv.wait_for_connection(timeout=max(deadline - time.time(), 0))
+        if not connected:
+            unreachable.append(pv.pvname)
+
+    new = [pv.pvname for pv in pvs if pv.pvname in _created and pv.pvname not in _reported]
+    _reported.update(new)
+    latency = {name: _connected[name] - _created[name] for name in new if name in _connected}
+    for name in sorted(latency, key=latency.get):
+        log.debug('  *** PV %s connected in %.3f s' % (name, latency[name]))
+    if latency:
+        slowest = max(latency, key=latency.get)
+        log.info('  *** %d PVs connected, slowest %s in %.3f s' % (len(latency), slowest, latency[slowest]))
+    for name in unreachable:
+        if name in new:
+            log.error('  *** PV %s did not connect within %.1f s' % (name, timeout))
+    return unreachable
+
+
+def pv_names(params):
+    """Names of the PVs of init_general_PVs, by key."""
+
+    names = {}
+
+    names['ShutterOpen']                    = params.shutter_open_pv_name  + '.VAL'
+    names['ShutterClose']                   = params.shutter_close_pv_name + '.VAL'
+    names['ShutterStatus']                  = params.shutter_status_pv_name + '.VAL'
+    names['SampleX']                        = params.sample_x_pv_name + '.VAL'
+    names['SampleXSet']                     = params.sample_x_pv_name + '.SET'
+    names['SampleXRBV']                     = params.sample_x_pv_name + '.RBV'
+    names['SampleY']                        = params.sample_y_pv_name + '.VAL'
+    names['SampleYSet']                     = params.sample_y_pv_name + '.SET'
+    names['SampleTheta']                    = params.sample_theta_pv_name + '.VAL'
+    names['Rotation']                       = params.rotation_pv_name + '.VAL'
+    names['RotationRBV']                    = params.rotation_pv_name + '.RBV'
+    names['RotationCnen']                   = params.rotation_pv_name + '.CNEN'
+    names['RotationAccl']                   = params.rotation_pv_name + '.ACCL'
+    names['RotationStop']                   = params.rotation_pv_name + '.STOP'
+    names['RotationSet']                    = params.rotation_pv_name + '.SET'
+    names['RotationVelo']                   = params.rotation_pv_name + '.VELO'
+    names['SampleXTop']                     = params.sample_x_top_pv_name + '.VAL'
+    names['SampleZTop']                     = params.sample_z_top_pv_name + '.VAL'
+    names['SamplePitch']                    = params.sample_pitch_pv_name + '.VAL'
+    names['SampleRoll']                     = params.sample_roll_pv_name + '.VAL'
+    names['SampleLamino']                   = params.sample_lamino_pv_name + '.VAL'
+    names['SampleTableY']                   = params.sample_table_y_pv_name + '.VAL'
+    names['LensSelect']                     = params.mctoptics_prefix + 'LensSelect'
+    names['LensName0']                      = params.mctoptics_prefix + 'Lens0Name'
+    names['LensName1']                      = params.mctoptics_prefix + 'Lens1Name'
+    names['LensName2']                      = params.mctoptics_prefix + 'Lens2Name'
+    names['FocusLens1']                     = params.focus_lens_1_pv_name + '.VAL'
+    names['FocusLens2']                     = params.focus_lens_2_pv_name + '.VAL'
+    names['FocusLens3']                     = params.focus_lens_3_pv_name + '.VAL'
 
     # detector pv's
     camera_prefix = params.detector_prefix + 'cam1:' 
 
-    global_PVs['CamManufacturer_RBV']       = PV(camera_prefix + 'Manufacturer_RBV')
-    global_PVs['CamModel']                  = PV(camera_prefix + 'Model_RBV')
-    global_PVs['Cam1SerialNumber']          = PV(camera_prefix + 'SerialNumber_RBV')
-    global_PVs['Cam1ImageMode']             = PV(camera_prefix + 'ImageMode')
-    global_PVs['Cam1ArrayCallbacks']        = PV(camera_prefix + 'ArrayCallbacks')
-    global_PVs['Cam1AcquirePeriod']         = PV(camera_prefix + 'AcquirePeriod')
-    global_PVs['Cam1SoftwareTrigger']       = PV(camera_prefix + 'SoftwareTrigger') 
-    global_PVs['Cam1AcquireTime']           = PV(camera_prefix + 'AcquireTime')
-    global_PVs['Cam1FrameType']             = PV(camera_prefix + 'FrameType')
-    global_PVs['Cam1AttributeFile']         = PV(camera_prefix + 'NDAttributesFile')
-    global_PVs['Cam1SizeX']                 = PV(camera_prefix + 'SizeX')
-    global_PVs['Cam1SizeY']                 = PV(camera_prefix + 'SizeY')
-    global_PVs['Cam1NumImages']             = PV(camera_prefix + 'NumImages')
-    global_PVs['Cam1TriggerMode']           = PV(camera_prefix + 'TriggerMode')
-    global_PVs['Cam1Acquire']               = PV(camera_prefix + 'Acquire')
-    global_PVs['Cam1SizeX_RBV']             = PV(camera_prefix + 'SizeX_RBV')
-    global_PVs['Cam1SizeY_RBV']             = PV(camera_prefix + 'SizeY_RBV')
-    global_PVs['Cam1MaxSizeX_RBV']          = PV(camera_prefix + 'MaxSizeX_RBV')
-    global_PVs['Cam1MaxSizeY_RBV']          = PV(camera_prefix + 'MaxSizeY_RBV')
-    global_PVs['Cam1PixelFormat_RBV']       = PV(camera_prefix + 'PixelFormat_RBV')
+    names['CamManufacturer_RBV']            = camera_prefix + 'Manufacturer_RBV'
+    names['CamModel']                       = camera_prefix + 'Model_RBV'
+    names['Cam1SerialNumber']               = camera_prefix + 'SerialNumber_RBV'
+    names['Cam1ImageMode']                  = camera_prefix + 'ImageMode'
+    names['Cam1ArrayCallbacks']             = camera_prefix + 'ArrayCallbacks'
+    names['Cam1AcquirePeriod']              = camera_prefix + 'AcquirePeriod'
+    names['Cam1SoftwareTrigger']            = camera_prefix + 'SoftwareTrigger'
+    names['Cam1AcquireTime']                = camera_prefix + 'AcquireTime'
+    names['Cam1FrameType']                  = camera_prefix + 'FrameType'
+    names['Cam1AttributeFile']              = camera_prefix + 'NDAttributesFile'
+    names['Cam1SizeX']                      = camera_prefix + 'SizeX'
+    names['Cam1SizeY']                      = camera_prefix + 'SizeY'
+    names['Cam1NumImages']                  = camera_prefix + 'NumImages'
+    names['Cam1TriggerMode']                = camera_prefix + 'TriggerMode'
+    names['Cam1TriggerModeRBV']             = camera_prefix + 'TriggerMode_RBV'
+    names['Cam1Acquire']                    = camera_prefix + 'Acquire'
+    names['Cam1AcquireRBV']                 = camera_prefix + 'Acquire_RBV'
+    names['Cam1SizeX_RBV']                  = camera_prefix + 'SizeX_RBV'
+    names['Cam1SizeY_RBV']                  = camera_prefix + 'SizeY_RBV'
+    names['Cam1MaxSizeX_RBV']               = camera_prefix + 'MaxSizeX_RBV'
+    names['Cam1MaxSizeY_RBV']               = camera_prefix + 'MaxSizeY_RBV'
+    names['Cam1MinX']                       = camera_prefix + 'MinX'
+    names['Cam1MinY']                       = camera_prefix + 'MinY'
+    names['Cam1BinX']                       = camera_prefix + 'BinX'
+    names['Cam1BinY']                       = camera_prefix + 'BinY'
+    names['Cam1ArraySizeX_RBV']             = camera_prefix + 'ArraySizeX_RBV'
+    names['Cam1ArraySizeY_RBV']             = camera_prefix + 'ArraySizeY_RBV'
+    names['Cam1PixelFormat_RBV']            = camera_prefix + 'PixelFormat_RBV'
 
     image_prefix = params.detector_prefix + 'image1:'
-    global_PVs['Image']                     = PV(image_prefix + 'ArrayData')
-    global_PVs['Cam1Display']               = PV(image_prefix + 'EnableCallbacks')
-
-    manufacturer = global_PVs['CamManufacturer_RBV'].get(as_string=True)
-    model = global_PVs['CamModel'].get(as_string=True)
-
-    if model == 'Oryx ORX-10G-51S5M':
-        log.info('Detector %s model %s:' % (manufacturer, model))
-        global_PVs['Cam1AcquireTimeAuto']   = PV(params.detector_prefix + 'AcquireTimeAuto')
-        global_PVs['Cam1FrameRateOnOff']    = PV(params.detector_prefix + 'FrameRateEnable')
-        global_PVs['Cam1TriggerSource']     = PV(params.detector_prefix + 'TriggerSource')
-        global_PVs['Cam1TriggerOverlap']    = PV(params.detector_prefix + 'TriggerOverlap')
-        global_PVs['Cam1ExposureMode']      = PV(params.detector_prefix + 'ExposureMode')
-        global_PVs['Cam1TriggerSelector']   = PV(params.detector_prefix + 'TriggerSelector')
-        global_PVs['Cam1TriggerActivation'] = PV(params.detector_prefix + 'TriggerActivation')
-    elif model == 'Oryx ORX-10G-310S9M':
-        log.info('Detector %s model %s:' % (manufacturer, model))
-        global_PVs['Cam1AcquireTimeAuto']   = PV(params.detector_prefix + 'AcquireTimeAuto')
-        global_PVs['Cam1FrameRateOnOff']    = PV(params.detector_prefix + 'FrameRateEnable')
-        global_PVs['Cam1TriggerSource']     = PV(params.detector_prefix + 'TriggerSource')
-        global_PVs['Cam1TriggerOverlap']    = PV(params.detector_prefix + 'TriggerOverlap')
-        global_PVs['Cam1ExposureMode']      = PV(params.detector_prefix + 'ExposureMode')
-        global_PVs['Cam1TriggerSelector']   = PV(params.detector_prefix + 'TriggerSelector')
-        global_PVs['Cam1TriggerActivation'] = PV(params.detector_prefix + 'TriggerActivation')
-    else:
-        log.error('Detector %s model %s is not supported' % (manufacturer, model))
-        return None        
+    names['Image']                          = image_prefix + 'ArrayData'
+    names['ImageCounter']                   = image_prefix + 'ArrayCounter_RBV'
+    names['Cam1Display']                    = image_prefix + 'EnableCallbacks'
+
+    # pv's of the supported models (DETECTOR_MODELS)
+    names['Cam1AcquireTimeAuto']            = params.detector_prefix + 'AcquireTimeAuto'
+    names['Cam1FrameRateOnOff']             = params.detector_prefix + 'FrameRateEnable'
+    names['Cam1TriggerSource']              = params.detector_prefix + 'TriggerSource'
+    names['Cam1TriggerOverlap']             = params.detector_prefix + 'TriggerOverlap'
+    names['Cam1ExposureMode']               = params.detector_prefix + 'ExposureMode'
+    names['Cam1TriggerSelector']            = params.detector_prefix + 'TriggerSelector'
+    names['Cam1TriggerActivation']          = params.detector_prefix + 'TriggerActivation'
 
     hdf_plugin_prefix = params.detector_prefix + 'HDF1:'
-    global_PVs['FPFullFileNameRBV']             = PV(hdf_plugin_prefix + 'FullFileName_RBV')
+    names['FPFullFileNameRBV']                  = hdf_plugin_prefix + 'FullFileName_RBV'
 
     tomoscan_prefix = params.tomoscan_prefix
-    global_PVs['TomoScanStart']             = PV(tomoscan_prefix + 'StartScan')
+    names['TomoScanStart']                  = tomoscan_prefix + 'StartScan'
+
+    pso_prefix = params.pso_prefix
+    names['PSOStartPos']                    = pso_prefix + 'startPos'
+    names['PSOEndPos']                      = pso_prefix + 'endPos'
+    names['PSOScanDelta']                   = pso_prefix + 'scanDelta'
+    names['PSOSlewSpeed']                   = pso_prefix + 'slewSpeed'
+    names['PSOTaxi']                        = pso_prefix + 'taxi'
+    names['PSOFly']                         = pso_prefix + 'fly'
 
     mctoptics_prefix = params.mctoptics_prefix
-    global_PVs['ImagePixelSize']            = PV(mctoptics_prefix + 'ImagePixelSize')
-    global_PVs['CameraSelect']              = PV(mctoptics_prefix + 'CameraSelect')
-    global_PVs['CameraRotation1']           = PV(params.camera_rotation_1_pv_name + '.VAL')
-    global_PVs['CameraRotation2']           = PV(params.camera_rotation_2_pv_name + '.VAL')
+    names['ImagePixelSize']                 = mctoptics_prefix + 'ImagePixelSize'
+    names['CameraSelect']                   = mctoptics_prefix + 'CameraSelect'
+    names['CameraRotation1']                = params.camera_rotation_1_pv_name + '.VAL'
+    names['CameraRotation2']                = params.camera_rotation_2_pv_name + '.VAL'
+
+    return names
+
+
+DETECTOR_MODELS = ('Oryx ORX-10G-51S5M', 'Oryx ORX-10G-310S9M')
+
+# keys used by the functions of this module and of detector; a command
+# connects the groups of the functions it calls (see init_general_PVs)
+SHUTTER_PVS = ('ShutterOpen', 'ShutterClose', 'ShutterStatus')
+DETECTOR_PVS = ('CamManufacturer_RBV', 'CamModel', 'Cam1SerialNumber', 'Cam1ImageMode', 'Cam1ArrayCallbacks',
+                'Cam1AcquireTime', 'Cam1SoftwareTrigger', 'Cam1SizeX', 'Cam1SizeY', 'Cam1NumImages', 'Cam1TriggerMode',
+                'Cam1TriggerModeRBV', 'Cam1Acquire', 'Cam1AcquireRBV', 'Cam1MaxSizeX_RBV', 'Cam1MaxSizeY_RBV',
+                'Cam1MinX', 'Cam1MinY', 'Cam1BinX', 'Cam1BinY', 'Cam1ArraySizeX_RBV', 'Cam1ArraySizeY_RBV',
+                'Cam1PixelFormat_RBV', 'Image', 'ImageCounter', 'Cam1Display', 'Cam1AcquireTimeAuto',
+                'Cam1FrameRateOnOff', 'Cam1TriggerSource', 'Cam1TriggerOverlap', 'Cam1ExposureMode',
+                'Cam1TriggerSelector', 'Cam1TriggerActivation', 'LensSelect')
+SAMPLE_PVS = ('SampleX', 'SampleXSet', 'SampleXRBV', 'SampleY')
+ROTATION_PVS = ('Rotation', 'RotationRBV', 'RotationVelo')
+FLY_PVS = ('PSOStartPos', 'PSOEndPos', 'PSOScanDelta', 'PSOSlewSpeed', 'PSOTaxi', 'PSOFly')
+ALIGNMENT_PVS = ('SampleRoll', 'SamplePitch', 'CameraSelect', 'CameraRotation1', 'CameraRotation2')
+OPTICS_PVS = ('ImagePixelSize', 'LensSelect', 'LensName0', 'LensName1', 'LensName2',
+              'FocusLens1', 'FocusLens2', 'FocusLens3')
+
+
+def init_general_PVs(params, keys=None):
+    """Connected PVs of *keys* (by default all of pv_names), by key.
+
+    The PVs and the camera model are connected first, so every channel
+    that does not connect within --pv-connection-timeout is reported up
+    front. Raises RuntimeError if one of them does not connect or if the
+    detector model is not supported.
+    """
+    names = pv_names(params)
+    global_PVs = {key: _pv(names[key]) for key in (names if keys is None else keys)}
+    camera = [_pv(names[key]) for key in ('CamManufacturer_RBV', 'CamModel')]
+
+    unreachable = connect(list(global_PVs.values()) + camera, params.pv_connection_timeout)
+    if unreachable:
+        raise RuntimeError('  *** %d PVs did not connect: %s'
+                           % (len(unreachable), ', '.join(sorted(set(unreachable)))))
+
+    manufacturer, model = (pv.get(as_string=True) for pv in camera)
+    if model not in DETECTOR_MODELS:
+        raise RuntimeError('  *** Detector %s model %s is not supported' % (manufacturer, model))
+    log.info('Detector %s model %s:' % (manufacturer, model))
 
     return global_PVs
 
@@ -213,30 +339,129 @@ def move_sample_out(global_PVs, params):
         log.info('      *** *** Move Sample Y in at: %f' % position)
         global_PVs['SampleY'].put(position, wait=True)
 
+def step_sample_out(params):
+    """Move the white field position one sample-out-step further away from the sample in position."""
+
+    axis = params.flat_field_axis
+
+    if axis in ('horizontal', 'both'):
+        direction = 1 if params.sample_out_x >= params.sample_in_x else -1
+        params.sample_out_x += direction * params.sample_out_step
+        log.info('      *** *** Sample X out position stepped to: %f' % params.sample_out_x)
+
+    if axis in ('vertical', 'both'):
+        direction = 1 if params.sample_out_y >= params.sample_in_y else -1
+        params.sample_out_y += direction * params.sample_out_step
+        log.info('      *** *** Sample Y out position stepped to: %f' % params.sample_out_y)
+
 def move_sample_y(global_PVs, target_mm):
     """Absolute move of hexapod Y to target_mm."""
     log.info('  *** move_sample_y: moving to %f mm' % target_mm)
-    global_PVs['SampleY'].put(target_mm, wait=True, timeout=120.0)
+    move(global_PVs, 'SampleY', target_mm, 120.0)
+
+def camera_rotation_key(global_PVs):
+    """global_PVs key of the active camera rotation motor."""
+    camera_select = global_PVs['CameraSelect'].get(as_string=True)
+    return 'CameraRotation1' if camera_select == 'Camera 1' else 'CameraRotation2'
 
 def move_camera_rotation(global_PVs, params, delta_deg):
     """Relative move of the active camera rotation motor by delta_deg."""
-    camera_select = global_PVs['CameraSelect'].get(as_string=True)
-    pv_key = 'CameraRotation1' if camera_select == 'Camera 1' else 'CameraRotation2'
+    pv_key = camera_rotation_key(global_PVs)
     current = global_PVs[pv_key].get()
     log.info('  *** move_camera_rotation: %s %+.4f deg (%.4f -> %.4f)' % (pv_key, delta_deg, current, current + delta_deg))
-    global_PVs[pv_key].put(current + delta_deg, wait=True, timeout=60.0)
+    move(global_PVs, pv_key, current + delta_deg, 60.0)
+
+def relative_target(global_PVs, pv_key, delta):
+    """Target of a relative move of global_PVs[pv_key] by delta, for start_moves."""
+    current = global_PVs[pv_key].get()
+    log.info('  *** relative move: %s %+.4f (%.4f -> %.4f)' % (pv_key, delta, current, current + delta))
+    return current + delta
+
+def start_moves(global_PVs, moves, max_timeout_sec=600.0):
+    """Start absolute moves of independent axes together, without waiting for them.
+
+    moves maps global_PVs keys to targets. Returns the started moves, to
+    be merged with those of further start_moves calls (each with its own
+    timeout) and passed to wait_moves.
+    """
+    apvs = aio.AsyncPVs(global_PVs)
+    started = {}
+    for pv_key, target in moves.items():
+        log.info('  *** start_moves: %s to %f' % (pv_key, target))
+        started[pv_key] = (target, time.time(), max_timeout_sec,
+                           aio.submit(aio.move(apvs[pv_key], target, max_timeout_sec)))
+    return started
+
+def wait_moves(global_PVs, started):
+    """Wait until all moves started by start_moves are complete.
+
+    The completion time of every axis is logged, and every axis that did
+    not complete within its timeout is reported. Returns True if all
+    moves completed.
+    """
+    completed = True
+    for pv_key, (target, start_time, max_timeout_sec, moved) in started.items():
+        try:
+            log.info('  *** wait_moves: %s reached %f in %5.2f s' % (pv_key, target, moved.result()))
+        except (asyncio.TimeoutError, concurrent.futures.TimeoutError):
+            log.error('  *** wait_moves: %s did not reach %f within %5.2f s' % (pv_key, target, max_timeout_sec))
+            completed = False
+    return completed
+
+def move(global_PVs, pv_key, target, max_timeout_sec=600.0):
+    """Absolute move of global_PVs[pv_key] to target, waiting for it (see aio.move).
+
+    A move that does not complete within max_timeout_sec is reported.
+    Returns True if it completed.
+    """
+    return wait_moves(global_PVs, start_moves(global_PVs, {pv_key: target}, max_timeout_sec))
 
 def move_sample_roll(global_PVs, delta_deg):
     """Relative move of hexapod roll by delta_deg."""
     current = global_PVs['SampleRoll'].get()
     log.info('  *** move_sample_roll: %+.4f deg (%.4f -> %.4f)' % (delta_deg, current, current + delta_deg))
-    global_PVs['SampleRoll'].put(current + delta_deg, wait=True, timeout=60.0)
+    move(global_PVs, 'SampleRoll', current + delta_deg, 60.0)
 
 def move_sample_pitch(global_PVs, delta_deg):
     """Relative move of hexapod pitch by delta_deg."""
     current = global_PVs['SamplePitch'].get()
     log.info('  *** move_sample_pitch: %+.4f deg (%.4f -> %.4f)' % (delta_deg, current, current + delta_deg))
-    global_PVs['SamplePitch'].put(current + delta_deg, wait=True, timeout=60.0)
+    move(global_PVs, 'SamplePitch', current + delta_deg, 60.0)
+
+def setup_fly(global_PVs, start_deg, end_deg, delta_deg, velocity):
+    """Program a PSO fly scan with a trigger every delta_deg from start_deg to end_deg and taxi to its start.
+
+    end_deg may be below start_deg to fly in the negative direction.
+
+    Returns the number of triggers the scan produces.
+    """
+    num_triggers = int(round(abs(end_deg - start_deg) / delta_deg)) + 1
+    log.info('  *** setup_fly: %d triggers from %f to %f deg at %f deg/s' % (num_triggers, start_deg, end_deg, velocity))
+    global_PVs['PSOStartPos'].put(start_deg, wait=True)
+    global_PVs['PSOEndPos'].put(end_deg, wait=True)
+    global_PVs['PSOScanDelta'].put(delta_deg, wait=True)
+    global_PVs['PSOSlewSpeed'].put(velocity, wait=True)
+    global_PVs['PSOTaxi'].put(1, wait=True, timeout=600.0)
+    return num_triggers
+
+def fly(global_PVs):
+    """Start the fly scan programmed by setup_fly without waiting for it."""
+    log.info('  *** fly: rotary stage flying')
+    global_PVs['PSOFly'].put(1)
+
+def wait_fly(global_PVs, max_timeout_sec):
+    """Wait for the fly scan started by fly to finish."""
+    return wait_pv(global_PVs['PSOFly'], 0, max_timeout_sec)
+
+def zero_sample_x(global_PVs):
+    """Redefine the current sample X position as 0 mm (motor record SET mode)."""
+    log.info('  *** zero_sample_x: %f mm redefined as 0 mm' % global_PVs['SampleXRBV'].get())
+    # the puts complete when the motor record has processed them; in SET mode the
+    # readback, not a motion, shows the new position
+    global_PVs['SampleXSet'].put(1, wait=True)
+    global_PVs['SampleX'].put(0, wait=True)
+    wait_pv(global_PVs['SampleXRBV'], 0, 5, tolerance=1e-4)
+    global_PVs['SampleXSet'].put(0, wait=True)
 
 def move_sample_in(global_PVs, params):
 
@@ -0,0 +1,882 @@
+# #########################################################################
+# Copyright (c) 2020, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2019-2020. UChicago Argonne, LLC. This software was produced  #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+"""
+Phase cross-correlation registration engine.
+
+Same algorithm as skimage.registration.phase_cross_correlation with
+normalization=None (integer peak of the cross-power spectrum followed by a
+matrix-multiply upsampled DFT refinement), but batched over stacks of
+equally shaped bands and kept in float32/complex64 throughout.
+"""
+
+import threading
+import numpy as np
+
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from scipy import fft
+
+from align import log
+
+RotationResult = namedtuple('RotationResult',
+    ['shift_x', 'shift_y', 'shift_top', 'shift_center', 'shift_bottom',
+     'tilt', 'intercept', 'residual', 'quality', 'strip_quality'])
+Quality = namedtuple('Quality', ['psr', 'peak_height', 'error'])
+
+STRIP_HEIGHT = 100
+STRIP_COUNT = 3
+HUBER_K = 1.345
+PYRAMID_LEVELS = (8, 4)
+PYRAMID_WINDOW = 512
+REFINERS = ('dft', 'parabolic', 'lk')
+TUKEY_ALPHA = 0.25
+SIDELOBE_EXCLUSION = 5
+WORKSPACE_CACHE_SIZE = 2048 * 1024**2
+
+_workspaces = OrderedDict()
+_workspaces_lock = threading.Lock()
+_workspace_cache_size = WORKSPACE_CACHE_SIZE
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+class Workspace(object):
+    """Preallocated buffers for registering a stack of bands of one shape.
+
+    *shape* is (2, ..., rows, cols): the reference bands are stored in
+    images[0] and the moving bands in images[1]. Tapers are computed on
+    first use and kept with the buffers.
+    """
+
+    def __init__(self, shape, dtype=np.float32):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        nrows, ncols = self.shape[-2:]
+        nbands = int(np.prod(self.shape[1:-2], dtype=int))
+        self.images = np.empty(self.shape, dtype=self.dtype)
+        self.spectra = np.empty(self.shape, dtype=np.complex64)
+        self.correlation = np.empty((nbands, nrows, ncols), dtype=np.complex64)
+        self.magnitude = np.empty((nbands, nrows, ncols), dtype=np.float32)
+        self._tapers = {}
+
+    @property
+    def nbytes(self):
+        return (self.images.nbytes + self.spectra.nbytes + self.correlation.nbytes + self.magnitude.nbytes
+                + sum(taper.nbytes for taper in self._tapers.values()))
+
+    def taper(self, kind):
+        """2D 'hann' or 'tukey' apodization window matching the band shape."""
+        if kind not in self._tapers:
+            nrows, ncols = self.shape[-2:]
+            self._tapers[kind] = np.outer(_taper_1d(kind, nrows), _taper_1d(kind, ncols)).astype(np.float32)
+        return self._tapers[kind]
+
+    def transform(self, taper=None):
+        """Spectra of images, computed in place in the spectra buffer.
+
+        Tapered images have their mean subtracted first, so the window
+        itself does not add a correlation peak at zero shift.
+        """
+        self.spectra.real[...] = self.images
+        self.spectra.imag[...] = 0
+        if taper:
+            self.spectra.real -= self.images.mean(axis=(-2, -1), keepdims=True)
+            self.spectra.real *= self.taper(taper)
+        return fft.fft2(self.spectra, axes=(-2, -1), overwrite_x=True)
+
+
+def _taper_1d(kind, n):
+    if kind == 'hann':
+        return np.hanning(n)
+    if kind == 'tukey':
+        width = int(TUKEY_ALPHA * (n - 1) / 2)
+        window = np.ones(n)
+        if width > 0:
+            edge = 0.5 * (1 - np.cos(np.pi * np.arange(width) / width))
+            window[:width] = edge
+            window[n - width:] = edge[::-1]
+        return window
+    raise ValueError('unknown taper %s' % kind)
+
+
+def workspace_nbytes(shape, dtype=np.float32):
+    """Memory needed by a Workspace of *shape*, excluding tapers."""
+    nitems = int(np.prod(shape, dtype=np.int64))
+    return nitems * (np.dtype(dtype).itemsize + 8) + nitems // 2 * (8 + 4)
+
+
+def workspace(shape, dtype=np.float32):
+    """Workspace for *shape* and *dtype* owned by the calling thread.
+
+    Each analysis thread gets its own buffers, so bands of the same shape
+    can be registered concurrently. Workspaces are kept in least recently
+    used order; the oldest ones are dropped once the cache holds more than
+    the workspace cache size, e.g. after an ROI or binning change leaves
+    their shape unused. A workspace larger than the cache size is not
+    kept at all.
+    """
+    key = (tuple(shape), np.dtype(dtype).str, threading.get_ident())
+    with _workspaces_lock:
+        ws = _workspaces.pop(key, None)
+        if ws is None:
+            # room is made before allocating, so the cache and the new
+            # buffers together stay within the cache size
+            nbytes = workspace_nbytes(shape, dtype)
+            while _workspaces and sum(w.nbytes for w in _workspaces.values()) + nbytes > _workspace_cache_size:
+                _workspaces.popitem(last=False)
+            ws = Workspace(shape, dtype)
+        _workspaces[key] = ws
+        while _workspaces and sum(w.nbytes for w in _workspaces.values()) > _workspace_cache_size:
+            _workspaces.popitem(last=False)
+    return ws
+
+
+def set_workspace_cache_size(nbytes):
+    """Bound the memory held by cached workspaces to *nbytes*."""
+    global _workspace_cache_size
+    with _workspaces_lock:
+        _workspace_cache_size = nbytes
+
+
+def clear_workspaces():
+    """Release all cached workspaces."""
+    with _workspaces_lock:
+        _workspaces.clear()
+
+
+def analysis_pool(workers):
+    """Process-wide thread pool with *workers* analysis threads.
+
+    The pool is created on first use and replaced when the number of
+    workers changes. numpy and scipy.fft release the GIL while they work
+    on large arrays, so registrations run in these threads execute on
+    separate cores.
+    """
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='align-analysis')
+            _pool_workers = workers
+        return _pool
+
+
+def run_tasks(tasks, workers=1):
+    """Results of calling each of *tasks* (no argument callables), in order.
+
+    With workers > 1 the tasks run in the analysis pool and each of them
+    uses an equal share of the workers for its FFTs; the results are
+    still returned in the order of *tasks*.
+    """
+    if workers <= 1 or len(tasks) == 1:
+        with fft.set_workers(max(1, workers)):
+            return [task() for task in tasks]
+    fft_workers = max(1, workers // len(tasks))
+
+    def run(task):
+        with fft.set_workers(fft_workers):
+            return task()
+
+    return list(analysis_pool(workers).map(run, tasks))
+
+
+def spectra(stack):
+    """Forward 2D FFT over the last two axes of a stack of real images.
+
+    Parameters
+    ----------
+    stack : ndarray
+        Real images, shape (..., rows, cols).
+
+    Returns
+    -------
+    ndarray
+        complex64 spectra with the same shape as *stack*.
+    """
+    return fft.fft2(np.asarray(stack, dtype=np.float32), axes=(-2, -1))
+
+
+def register_spectra(src_freq, target_freq, upsample_factor=100, ws=None, refiner='dft', return_quality=False):
+    """Sub-pixel shifts between two stacks of spectra.
+
+    Parameters
+    ----------
+    src_freq : ndarray
+        Reference spectra, shape (rows, cols) or (bands, rows, cols).
+    target_freq : ndarray
+        Moving spectra, same shape as *src_freq*.
+    upsample_factor : int, optional
+        Shifts are resolved to 1 / upsample_factor of a pixel.
+    ws : Workspace, optional
+        Buffers for the cross-correlation. When given, the cross-power
+        spectrum is formed in place of *target_freq*.
+    refiner : str, optional
+        Sub-pixel refinement of the integer peak, one of REFINERS:
+        'dft' upsampled DFT to 1 / upsample_factor px, 'parabolic' 3-point
+        parabola through the correlation peak (~0.1 px, almost free),
+        'lk' Lucas-Kanade gradient fit evaluated on the spectra.
+    return_quality : bool, optional
+        Also return the Quality of each band (see correlation_quality).
+
+    Returns
+    -------
+    ndarray
+        (row, col) shift of each band, shape (2,) or (bands, 2), in the
+        sign convention of phase_cross_correlation.
+    Quality
+        Only if return_quality: psr, peak_height and error of each band,
+        floats or arrays of shape (bands,).
+    """
+    if refiner not in REFINERS:
+        raise ValueError('unknown sub-pixel refiner %s' % refiner)
+    single = src_freq.ndim == 2
+    nrows, ncols = src_freq.shape[-2:]
+    src_freq = src_freq.reshape(-1, nrows, ncols)
+    target_freq = target_freq.reshape(-1, nrows, ncols)
+    nbands = src_freq.shape[0]
+
+    if refiner == 'lk':
+        # the gradient normal matrix only needs the moving power spectrum
+        power = np.abs(target_freq, out=None if ws is None else ws.magnitude)
+        power *= power
+        normal = _frequency_moments(power)
+        del power
+    if return_quality:
+        energy = [_energy(freq, None if ws is None else ws.magnitude) for freq in (src_freq, target_freq)]
+
+    if ws is None:
+        image_product = src_freq * target_freq.conj()
+        cross_correlation = np.abs(fft.ifft2(image_product, axes=(-2, -1)))
+    else:
+        image_product = np.multiply(src_freq, np.conjugate(target_freq, out=target_freq), out=target_freq)
+        np.copyto(ws.correlation, image_product)
+        cross_correlation = np.abs(fft.ifft2(ws.correlation, axes=(-2, -1), overwrite_x=True), out=ws.magnitude)
+    peaks = np.argmax(cross_correlation.reshape(nbands, -1), axis=1)
+
+    shape = np.array([nrows, ncols])
+    shifts = np.stack(np.unravel_index(peaks, (nrows, ncols)), axis=1).astype(np.float64)
+    wrap = shifts > np.trunc(shape / 2)
+    shifts[wrap] -= np.broadcast_to(shape, shifts.shape)[wrap]
+
+    if refiner == 'parabolic':
+        shifts += _parabolic_offsets(cross_correlation, peaks)
+    elif refiner == 'lk':
+        shifts = _lucas_kanade(image_product, normal, shifts)
+    elif upsample_factor > 1:
+        shifts = np.round(shifts * upsample_factor) / upsample_factor
+        region_size = int(np.ceil(upsample_factor * 1.5))
+        dftshift = np.trunc(region_size / 2.0)
+        offsets = dftshift - shifts * upsample_factor
+        upsampled = np.abs(_upsampled_dft(image_product, region_size, upsample_factor, offsets))
+        maxima = np.argmax(upsampled.reshape(nbands, -1), axis=1)
+        maxima = np.stack(np.unravel_index(maxima, (region_size, region_size)), axis=1)
+        shifts += (maxima - dftshift) / upsample_factor
+
+    shifts[:, shape == 1] = 0
+    if not return_quality:
+        return shifts[0] if single else shifts
+    quality = correlation_quality(image_product, cross_correlation, peaks, *energy)
+    if single:
+        return shifts[0], Quality(*(float(value[0]) for value in quality))
+    return shifts, quality
+
+
+def _energy(freq, out=None):
+    """Per band sum of squares of the mean subtracted images, from their spectra."""
+    nrows, ncols = freq.shape[-2:]
+    power = np.square(np.abs(freq, out=out), out=out)
+    return (power.sum(axis=(-2, -1), dtype=np.float64) - power[:, 0, 0]) / (nrows * ncols)
+
+
+def correlation_quality(image_product, cross_correlation, peaks, src_energy, target_energy):
+    """Confidence of the integer peaks of a stack of cross-correlations.
+
+    psr is the peak-to-sidelobe ratio of the phase correlation: the
+    cross-power spectrum is whitened (divided by its magnitude) and its
+    mean (DC) term removed, so neither the sample silhouette nor the open
+    beam level dominates the surface. It is the height of that surface
+    at the peak above the mean outside a (2 SIDELOBE_EXCLUSION + 1)^2
+    pixel window around it, in units of the standard deviation there.
+    Uncorrelated images stay below about 5, or 8 with a hann taper,
+    whose windowed spectra give the surface heavier tails.
+    peak_height is the correlation coefficient of the mean subtracted
+    images at the peak shift (1 for identical, shifted images) and error
+    the translation invariant normalized RMS error sqrt(1 - peak_height^2)
+    of phase_cross_correlation, both computed without the DC term, which
+    on flat field normalized images would put every peak close to 1.
+
+    Parameters
+    ----------
+    image_product : ndarray
+        Cross-power spectra, shape (bands, rows, cols); overwritten.
+    cross_correlation : ndarray
+        Correlation magnitudes, shape (bands, rows, cols); overwritten.
+    peaks : ndarray
+        Flat index of the peak of each band.
+    src_energy, target_energy : ndarray
+        Sum of squares of the mean subtracted images of each band.
+
+    Returns
+    -------
+    Quality
+        Arrays of shape (bands,).
+    """
+    nbands, nrows, ncols = cross_correlation.shape
+    size = nrows * ncols
+    band = np.arange(nbands)
+    row, col = np.unravel_index(peaks, (nrows, ncols))
+    dc = image_product[:, 0, 0].real.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        peak_height = np.abs(cross_correlation[band, row, col] - dc / size) / np.sqrt(src_energy * target_energy)
+    peak_height = np.nan_to_num(np.clip(peak_height, 0, 1))
+
+    magnitude = np.abs(image_product, out=cross_correlation)
+    np.maximum(magnitude, np.finfo(np.float32).tiny, out=magnitude)
+    whitened = np.divide(image_product, magnitude, out=image_product)
+    whitened[:, 0, 0] = 0
+    surface = magnitude
+    np.copyto(surface, fft.ifft2(whitened, axes=(-2, -1), overwrite_x=True).real)
+    peak = surface[band, row, col].astype(np.float64)
+
+    half_rows = min(SIDELOBE_EXCLUSION, (nrows - 1) // 2)
+    half_cols = min(SIDELOBE_EXCLUSION, (ncols - 1) // 2)
+    rows = (row[:, None] + np.arange(-half_rows, half_rows + 1)) % nrows
+    cols = (col[:, None] + np.arange(-half_cols, half_cols + 1)) % ncols
+    window = surface[band[:, None, None], rows[:, :, None], cols[:, None, :]].astype(np.float64)
+    flat = surface.reshape(nbands, -1)
+    sidelobe_size = max(size - window[0].size, 1)
+    mean = (flat.sum(axis=1, dtype=np.float64) - window.sum(axis=(1, 2))) / sidelobe_size
+    # centered sums of squares: the sidelobes are tiny next to the peak
+    centered = np.empty(size, dtype=np.float32)
+    sidelobe_sq = np.empty(nbands)
+    for b in range(nbands):
+        np.subtract(flat[b], np.float32(mean[b]), out=centered)
+        sidelobe_sq[b] = (float(np.dot(centered, centered))
+                          - np.square(window[b] - mean[b]).sum())
+    std = np.sqrt(np.maximum(sidelobe_sq, 0) / sidelobe_size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        psr = np.where(std > 0, (peak - mean) / std, 0)
+    return Quality(psr=psr, peak_height=peak_height, error=np.sqrt(1 - peak_height**2))
+
+
+def _parabolic_offsets(cross_correlation, peaks):
+    """Sub-pixel peak offsets from a parabola through each peak and its neighbours."""
+    nbands, nrows, ncols = cross_correlation.shape
+    band = np.arange(nbands)
+    row, col = np.unravel_index(peaks, (nrows, ncols))
+    center = cross_correlation[band, row, col].astype(np.float64)
+    offsets = np.zeros((nbands, 2))
+    for axis, (before, after) in enumerate([(cross_correlation[band, (row - 1) % nrows, col],
+                                             cross_correlation[band, (row + 1) % nrows, col]),
+                                            (cross_correlation[band, row, (col - 1) % ncols],
+                                             cross_correlation[band, row, (col + 1) % ncols])]):
+        curvature = before - 2 * center + after
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offset = np.where(curvature < 0, 0.5 * (before - after) / curvature, 0)
+        offsets[:, axis] = np.clip(offset, -0.5, 0.5)
+    return offsets
+
+
+def _frequency_moments(power):
+    """Per band 2x2 matrix of sum(k_i * k_j * power) over the spectrum."""
+    nbands, nrows, ncols = power.shape
+    krow = fft.fftfreq(nrows)
+    kcol = fft.fftfreq(ncols)
+    row_power = power.sum(axis=2, dtype=np.float64)
+    weighted_col = power @ kcol.astype(np.float32)
+    moments = np.empty((nbands, 2, 2))
+    moments[:, 0, 0] = row_power @ krow**2
+    moments[:, 1, 1] = power.sum(axis=1, dtype=np.float64) @ kcol**2
+    moments[:, 0, 1] = moments[:, 1, 0] = weighted_col @ krow
+    return moments
+
+
+def _lucas_kanade(image_product, moments, shifts, iterations=5, tolerance=1e-3):
+    """Refine *shifts* by Gauss-Newton on the squared image difference.
+
+    By Parseval the Lucas-Kanade normal equations can be written on the
+    spectra: the matrix is 4 pi^2 sum(k k^T |F1|^2) (*moments*) and the
+    right hand side -2 pi sum(k Im(F0 F1* exp(2 pi i k.s))), which is two
+    matrix-vector products with the cross-power spectrum per iteration.
+    """
+    nbands, nrows, ncols = image_product.shape
+    krow = fft.fftfreq(nrows)
+    kcol = fft.fftfreq(ncols)
+    normal = 4 * np.pi**2 * moments
+    for _ in range(iterations):
+        row_ramp = np.exp(2j * np.pi * krow[None, :] * shifts[:, 0:1]).astype(np.complex64)
+        col_ramp = np.exp(2j * np.pi * kcol[None, :] * shifts[:, 1:2]).astype(np.complex64)
+        along_cols = np.einsum('bij,bj->bi', image_product, col_ramp)
+        along_cols_k = np.einsum('bij,bj->bi', image_product, col_ramp * kcol.astype(np.float32))
+        rhs = np.stack([np.einsum('bi,bi->b', along_cols, row_ramp * krow).imag,
+                        np.einsum('bi,bi->b', along_cols_k, row_ramp).imag], axis=1) * -2 * np.pi
+        step = np.linalg.solve(normal + 1e-12 * np.eye(2), rhs[..., None])[..., 0]
+        shifts = shifts + step
+        if np.all(np.abs(step) < tolerance):
+            break
+    return shifts
+
+
+def refinement(residual, threshold, upsample_factor=100):
+    """Cheapest refiner able to resolve the next correction.
+
+    The shift has to be known to about a tenth of the larger of the
+    current *residual* and the convergence *threshold* (px). Returns
+    (refiner, upsample_factor), or None when that needs the full
+    upsample_factor precision anyway.
+    """
+    if residual is None:
+        return 'parabolic', 1
+    precision = max(abs(residual), threshold) / 10
+    if precision >= 0.25:
+        return 'parabolic', 1
+    needed = max(10, int(np.ceil(1 / precision)))
+    if needed >= upsample_factor:
+        return None
+    return 'dft', needed
+
+
+def _upsampled_dft(data, region_size, upsample_factor, offsets):
+    """Upsampled inverse DFT of a stack of spectra by matrix multiplication.
+
+    Each band is sampled on its own *region_size* x *region_size* grid,
+    starting at its (row, col) entry of *offsets*, without zero padding.
+    This is the complex conjugate of skimage's _upsampled_dft applied to
+    the conjugated spectra, which saves conjugating the whole stack.
+    """
+    nbands, nrows, ncols = data.shape
+    grid = np.arange(region_size)
+
+    def kernel(n, offset):
+        # one band at a time, so the float64 phase is never held for the whole stack
+        out = np.empty((nbands, region_size, n), dtype=np.complex64)
+        freq = 2 * np.pi * fft.fftfreq(n, upsample_factor)
+        for band in range(nbands):
+            phase = np.outer(grid - offset[band], freq)
+            np.cos(phase, out=out[band].real)
+            np.sin(phase, out=out[band].imag)
+        return out
+
+    col_kernel = kernel(ncols, offsets[:, 1])
+    row_kernel = kernel(nrows, offsets[:, 0])
+    return row_kernel @ (data @ col_kernel.transpose(0, 2, 1))
+
+
+def _register_workspace(ws, upsample_factor, taper=None, refiner='dft', return_quality=False):
+    """Register images[1] to images[0] of a filled Workspace."""
+    freq = ws.transform(taper)
+    return register_spectra(freq[0], freq[1], upsample_factor, ws, refiner, return_quality)
+
+
+def bin_image(stack, factor):
+    """Block-mean bin the last two axes of *stack* by *factor* (float32).
+
+    Rows and columns that do not fill a whole block are dropped; an axis
+    shorter than *factor* is left unbinned.
+    """
+    stack = np.asarray(stack, dtype=np.float32)
+    *lead, nrows, ncols = stack.shape
+    frow = factor if nrows >= factor else 1
+    fcol = factor if ncols >= factor else 1
+    stack = stack[..., :nrows // frow * frow, :ncols // fcol * fcol]
+    binned = stack.reshape(*lead, nrows // frow, frow, ncols // fcol, fcol).mean(axis=(-3, -1), dtype=np.float32)
+    return binned, np.array([frow, fcol])
+
+
+def _window_slices(shape, offset, size):
+    """Slices of the windows of *size* of a reference and a moving band displaced by *offset*."""
+    ref_slices, mov_slices = [], []
+    for axis, n in enumerate(shape):
+        start = max(0, offset[axis]) + (n - abs(offset[axis]) - size[axis]) // 2
+        ref_slices.append(slice(start, start + size[axis]))
+        mov_slices.append(slice(start - offset[axis], start - offset[axis] + size[axis]))
+    return tuple(ref_slices), tuple(mov_slices)
+
+
+def _crop_pairs(reference, moving, shifts, size):
+    """Workspace holding windows of *size* from each band of *reference* and *moving*.
+
+    The windows are displaced by the integer part of each band's shift
+    and centered in the overlap of the two bands, so the remaining shift
+    between them is the fractional residual of *shifts*.
+    """
+    nbands = reference.shape[0]
+    offsets = np.round(shifts).astype(int)
+    ws = workspace((2, nbands) + tuple(int(n) for n in size))
+    for band in range(nbands):
+        ref_slices, mov_slices = _window_slices(reference.shape[1:], offsets[band], size)
+        ws.images[0, band] = reference[band][ref_slices]
+        ws.images[1, band] = moving[band][mov_slices]
+    return ws
+
+
+def _binned_pairs(reference, moving, shifts, size, factor):
+    """The windows of _crop_pairs binned by *factor*, and the binning of each axis.
+
+    Each window is binned straight from a view of its band, so only the
+    binned stack is allocated, not a full resolution Workspace.
+    """
+    nbands = reference.shape[0]
+    offsets = np.round(shifts).astype(int)
+    binned = None
+    for band in range(nbands):
+        for side, (bands, slices) in enumerate(zip((reference, moving),
+                                                   _window_slices(reference.shape[1:], offsets[band], size))):
+            image, binning = bin_image(bands[band][slices], factor)
+            if binned is None:
+                binned = np.empty((2, nbands) + image.shape, dtype=np.float32)
+            binned[side, band] = image
+    return binned, binning
+
+
+def register_pyramid(reference, moving, upsample_factor=100, levels=PYRAMID_LEVELS, window=PYRAMID_WINDOW,
+                     taper=None, refiner='dft', return_quality=False):
+    """Coarse-to-fine registration of two stacks of bands.
+
+    The integer shift is estimated on block-binned copies of the bands,
+    from the coarsest binning factor in *levels* to the finest, each
+    level working on the overlap left by the previous estimate. The
+    sub-pixel shift is then refined at full resolution on a window of
+    at most *window* x *window* pixels around the center of the overlap.
+
+    Parameters
+    ----------
+    reference : ndarray
+        Reference bands, shape (rows, cols) or (bands, rows, cols).
+    moving : ndarray
+        Moving bands, same shape as *reference*.
+    upsample_factor : int, optional
+        Shifts are resolved to 1 / upsample_factor of a pixel.
+    levels : sequence of int, optional
+        Binning factors, coarsest first; 1 finds the integer shift at
+        full resolution.
+    window : int, optional
+        Size of the full resolution refinement window (pixels); None
+        refines on the whole overlap.
+    taper : str, optional
+        Apodization ('hann' or 'tukey') of the refinement window.
+    refiner : str, optional
+        Sub-pixel refiner of the full resolution window (see register_spectra).
+    return_quality : bool, optional
+        Also return the Quality of the full resolution window of each band.
+
+    Returns
+    -------
+    ndarray
+        (row, col) shift of each band, shape (2,) or (bands, 2).
+    Quality
+        Only if return_quality, see register_spectra.
+    """
+    single = reference.ndim == 2
+    if single:
+        reference = reference[None]
+        moving = moving[None]
+    shape = np.array(reference.shape[1:])
+    shifts = np.zeros((reference.shape[0], 2))
+
+    for factor in sorted(levels, reverse=True):
+        overlap = shape - np.abs(np.round(shifts)).max(axis=0).astype(int)
+        binned, binning = _binned_pairs(reference, moving, shifts, overlap, factor)
+        freq = spectra(binned)
+        shifts += register_spectra(freq[0], freq[1], upsample_factor=1) * binning
+
+    overlap = shape - np.abs(np.round(shifts)).max(axis=0).astype(int)
+    if np.any(overlap < 2):
+        raise ValueError('registration shift %s leaves no overlap between images' % shifts.tolist())
+    ws = _crop_pairs(reference, moving, shifts, np.minimum(overlap, window) if window else overlap)
+    fine = _register_workspace(ws, upsample_factor, taper, refiner, return_quality)
+    if return_quality:
+        fine, quality = fine
+    shifts = np.round(shifts) + fine
+    if single:
+        shifts = shifts[0]
+        if return_quality:
+            quality = Quality(*(float(value[0]) for value in quality))
+    return (shifts, quality) if return_quality else shifts
+
+
+def _over_budget(shape, memory_budget):
+    if memory_budget and workspace_nbytes(shape) > memory_budget:
+        log.info('  ***  *** registering %s images coarse-to-fine: %d MB of buffers exceed the %d MB budget'
+                 % ('x'.join(str(n) for n in shape[-2:]), workspace_nbytes(shape) // 1024**2, memory_budget // 1024**2))
+        return True
+    return False
+
+
+def register(reference, moving, upsample_factor=100, pyramid=None, window=PYRAMID_WINDOW, taper=None,
+             memory_budget=None, refiner='dft', workers=1, return_quality=False):
+    """Sub-pixel (row, col) shift registering *moving* to *reference*.
+
+    If *pyramid* is a sequence of binning factors the shift is found
+    coarse-to-fine by register_pyramid, otherwise on the full images.
+    Full resolution registration also falls back to register_pyramid
+    when its buffers would exceed *memory_budget* bytes. The 'lk'
+    refiner is a local fit that the content wrapped around by a large
+    shift would bias, so it always refines on the overlap of the images
+    once the integer shift is known. The FFTs use *workers* threads.
+    With return_quality the Quality of the registration is returned
+    with the shift (see register_spectra).
+    """
+    return run_tasks([lambda: _register(reference, moving, upsample_factor, pyramid, window, taper,
+                                        memory_budget, refiner, return_quality)], workers)[0]
+
+
+def _register(reference, moving, upsample_factor, pyramid, window, taper, memory_budget, refiner,
+              return_quality=False):
+    if not pyramid and _over_budget((2,) + reference.shape, memory_budget):
+        pyramid = PYRAMID_LEVELS
+    if not pyramid and refiner == 'lk':
+        pyramid, window = (1,), None
+    if pyramid:
+        return register_pyramid(reference, moving, upsample_factor, pyramid, window, taper, refiner, return_quality)
+    ws = workspace((2,) + reference.shape)
+    ws.images[0] = reference
+    ws.images[1] = moving
+    return _register_workspace(ws, upsample_factor, taper, refiner, return_quality)
+
+
+def strip_bounds(nrows, strip_height=STRIP_HEIGHT, strip_count=STRIP_COUNT):
+    """Row ranges of *strip_count* strips evenly spaced from top to bottom."""
+    if strip_count < 2:
+        raise ValueError('at least 2 strips are needed to measure the rotation axis tilt')
+    strip_height = min(strip_height, nrows)
+    starts = np.round(np.linspace(0, nrows - strip_height, strip_count)).astype(int)
+    return [(start, start + strip_height) for start in starts]
+
+
+def fit_line(x, y, iterations=20):
+    """Robust straight line fit of *y* against *x*.
+
+    Huber M-estimate by iteratively reweighted least squares, with the
+    residual scale taken from the median absolute deviation, so a few
+    bad points (e.g. strips with no sample in them) only have a bounded
+    pull on the line.
+
+    Returns
+    -------
+    slope, intercept, residual : float
+        Line parameters and the weighted RMS residual.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    A = np.stack([x, np.ones_like(x)], axis=1)
+    weights = np.ones_like(y)
+    for _ in range(iterations):
+        sqrt_w = np.sqrt(weights)
+        coef = np.linalg.lstsq(A * sqrt_w[:, None], y * sqrt_w, rcond=None)[0]
+        res = y - A @ coef
+        scale = 1.4826 * np.median(np.abs(res - np.median(res)))
+        if scale < 1e-6:
+            break
+        u = np.abs(res) / (HUBER_K * scale)
+        new_weights = np.where(u <= 1, 1.0, 1.0 / np.maximum(u, 1e-12))
+        if np.allclose(new_weights, weights):
+            break
+        weights = new_weights
+    residual = np.sqrt(np.sum(weights * res**2) / np.sum(weights))
+    return float(coef[0]), float(coef[1]), float(residual)
+
+
+def register_rotation(sample_0, sample_180, strip_height=STRIP_HEIGHT, strip_count=STRIP_COUNT,
+                      upsample_factor=100, pyramid=None, window=PYRAMID_WINDOW, taper=None,
+                      memory_budget=None, refiner='dft', workers=1, mirrored=False):
+    """Rotation axis shifts from a 0 deg and a 180 deg projection.
+
+    The 180 deg projection is flipped horizontally (unless it is already
+    *mirrored*) while it is copied into the cached workspace and both
+    images are transformed together;
+    *strip_count* horizontal strips of both images are transformed as
+    stacked batches and registered in a single pass per batch. The full
+    frame and the strip batches are independent and run concurrently on
+    *workers* threads. A robust line fit of strip shift against row gives
+    the rotation axis profile: shift_top, shift_center and shift_bottom
+    are read from the fitted line, so a single empty or low contrast
+    strip does not corrupt the tilt.
+
+    Parameters
+    ----------
+    sample_0 : ndarray
+        Normalized 2D projection at 0 deg.
+    sample_180 : ndarray
+        Normalized 2D projection at 180 deg, flipped horizontally if
+        *mirrored*.
+    strip_height : int, optional
+        Number of rows in each strip.
+    strip_count : int, optional
+        Number of strips, evenly spaced from the top to the bottom row.
+    upsample_factor : int, optional
+        Shifts are resolved to 1 / upsample_factor of a pixel.
+    pyramid : sequence of int, optional
+        Binning factors for coarse-to-fine registration of the full frame
+        and of the strips; None registers them at full resolution.
+    window : int, optional
+        Size of the full resolution refinement window in pyramid mode.
+    taper : str, optional
+        Apodization ('hann' or 'tukey') applied before each transform.
+    memory_budget : int, optional
+        Upper bound (bytes) on the registration buffers, shared by the
+        batches registered concurrently.
+    refiner : str, optional
+        Sub-pixel refiner, see register_spectra.
+    workers : int, optional
+        Number of analysis threads.
+    mirrored : bool, optional
+        True if *sample_180* was already flipped horizontally, e.g. by
+        util.FlatFieldCorrector.apply.
+
+    Returns
+    -------
+    RotationResult
+        Rotation axis shifts in pixels (half the image shift). tilt is
+        shift_bottom - shift_top, intercept the fitted shift at the
+        center row and residual the RMS misfit of the strips to the line.
+        quality is the Quality of the full frame registration and
+        strip_quality a tuple with the Quality of each strip.
+    """
+    nrows, ncols = sample_0.shape
+    flipped = sample_180 if mirrored else sample_180[:, ::-1]
+    bounds = strip_bounds(nrows, strip_height, strip_count)
+    height = bounds[0][1] - bounds[0][0]
+
+    block = len(bounds)
+    if workers > 1:
+        block = -(-len(bounds) // workers)
+    if memory_budget:
+        memory_budget //= max(1, min(workers, len(bounds) + 1))
+        # a strip's buffers and its complex64 upsampled DFT kernels
+        strip_nbytes = (workspace_nbytes((2, 1, height, ncols))
+                        + int(np.ceil(upsample_factor * 1.5)) * (height + ncols) * 8)
+        block = max(1, min(block, memory_budget // strip_nbytes))
+
+    def register_strips(strips):
+        ws = workspace((2, len(strips), height, ncols))
+        for band, (start, stop) in enumerate(strips):
+            ws.images[0, band] = sample_0[start:stop]
+            ws.images[1, band] = flipped[start:stop]
+        if pyramid or refiner == 'lk':
+            return register_pyramid(ws.images[0], ws.images[1], upsample_factor, pyramid or (1,),
+                                    window if pyramid else None, taper, refiner, return_quality=True)
+        return _register_workspace(ws, upsample_factor, taper, refiner, return_quality=True)
+
+    tasks = [lambda: _register(sample_0, flipped, upsample_factor, pyramid, window, taper, memory_budget, refiner,
+                               return_quality=True)]
+    tasks += [lambda strips=bounds[first:first + block]: register_strips(strips)
+              for first in range(0, len(bounds), block)]
+    (shift, quality), *blocks = run_tasks(tasks, workers)
+    shift = shift / 2
+    strip_shift = np.concatenate([block_shift for block_shift, _ in blocks])[:, 1] / 2
+    strip_quality = [np.concatenate(values) for values in zip(*(block_quality for _, block_quality in blocks))]
+
+    rows = np.array([(start + stop - 1) / 2 for start, stop in bounds]) - (nrows - 1) / 2
+    slope, intercept, residual = fit_line(rows, strip_shift)
+    shift_top = float(intercept + slope * rows[0])
+    shift_bottom = float(intercept + slope * rows[-1])
+
+    return RotationResult(shift_x=float(shift[1]), shift_y=float(shift[0]),
+                          shift_top=shift_top, shift_center=intercept, shift_bottom=shift_bottom,
+                          tilt=shift_bottom - shift_top, intercept=intercept, residual=residual,
+                          quality=quality,
+                          strip_quality=tuple(Quality(*(float(value) for value in band))
+                                              for band in zip(*strip_quality)))
+
+
+def opposed_pairs(angles):
+    """(angle, angle + 180) pairs of rotary stage *angles* (deg), in the order of *angles*."""
+    pairs = []
+    for angle in angles:
+        for other in angles:
+            if abs((other - angle) % 360 - 180) < 1e-6 and (other, angle) not in pairs:
+                pairs.append((angle, other))
+    return pairs
+
+
+def solve_rotation_axis(angles, results):
+    """Rotation axis from the registrations of several projection pairs.
+
+    Every pair of projections 180 deg apart sees the same rotation axis
+    center and tilt, so their least squares estimates are the means of
+    the pair measurements. Only the vertical shift of a pair depends on
+    its angle: it follows the pitch of the axis around the rotation,
+    shift_y(angle) = p cos(angle) + q sin(angle), and (p, q) are fitted
+    by linear least squares over all pairs. The terms are independent,
+    so this is the same solution as one joint least squares problem.
+
+    Parameters
+    ----------
+    angles : sequence of float
+        Angle (deg) of the first projection of each pair.
+    results : sequence of RotationResult
+        register_rotation result of each pair.
+
+    Returns
+    -------
+    result : RotationResult
+        Rotation axis of the least squares solution, in the frame of the
+        0 deg pair: shift_y is p. residual is the RMS misfit of the pair
+        measurements, quality the lowest quality pair and strip_quality
+        the strips of all pairs.
+    shift_y_90 : float
+        The vertical shift q of a 90/270 deg pair.
+    """
+    theta = np.radians(np.asarray(angles, dtype=np.float64))
+    measured = np.array([(result.shift_x, result.intercept, result.tilt) for result in results])
+    shift_x, intercept, tilt = (float(value) for value in measured.mean(axis=0))
+    pitch = np.stack([np.cos(theta), np.sin(theta)], axis=1)
+    shift_y_measured = np.array([result.shift_y for result in results])
+    shift_y, shift_y_90 = (float(value) for value in np.linalg.lstsq(pitch, shift_y_measured, rcond=None)[0])
+    misfit = np.concatenate([(measured - measured.mean(axis=0)).ravel(),
+                             shift_y_measured - pitch @ (shift_y, shift_y_90)])
+    residual = float(np.sqrt(np.mean(misfit ** 2)))
+
+    result = RotationResult(shift_x=shift_x, shift_y=shift_y,
+                            shift_top=intercept - tilt / 2, shift_center=intercept,
+                            shift_bottom=intercept + tilt / 2,
+                            tilt=tilt, intercept=intercept, residual=residual,
+                            quality=min((result.quality for result in results), key=lambda quality: quality.psr),
+                            strip_quality=sum((result.strip_quality for result in results), ()))
+    return result, shift_y_90
@@ -47,26 +47,51 @@
 Module for sample alignment.
 """
 
+import os
 import sys
 import time
+import threading
 import numpy as np
 
 from collections import namedtuple
-from skimage.registration import phase_cross_correlation
+from concurrent.futures import ThreadPoolExecutor
 
 from align import log
 from align import detector
 from align import pv
 from align import config
 from align import util
+from align import register
+from align.register import RotationResult
 
-RotationResult = namedtuple('RotationResult',
-    ['shift_x', 'shift_y', 'shift_top', 'shift_center', 'shift_bottom'])
+# sample_0 and sample_180 are taken at angle and angle + 180 deg; sample_180
+# is stored flipped horizontally, as registered against sample_0
+RotationFrames = namedtuple('RotationFrames', ['sample_0', 'sample_180', 'binning', 'angle'], defaults=(0.0,))
+
+
+# frames are RotationFrames, or a tuple of them in multi-angle mode; result
+# is a future of the RotationResult (a list of them, one per pair)
+Measurement = namedtuple('Measurement', ['frames', 'refinement', 'result', 'sample_y'])
+
+
+class RegistrationQualityError(RuntimeError):
+    """A rotation measurement stayed below the registration quality floors."""
+
+
+# PVs connected by the resolution and rotation commands (see pv.init_general_PVs)
+RESOLUTION_PVS = pv.SHUTTER_PVS + pv.DETECTOR_PVS + pv.SAMPLE_PVS + ('ImagePixelSize',)
+ROTATION_PVS = (pv.SHUTTER_PVS + pv.DETECTOR_PVS + pv.SAMPLE_PVS + pv.ROTATION_PVS + pv.ALIGNMENT_PVS
+                + pv.OPTICS_PVS + ('SampleTableY',))
+
+
+_corrector_cache = {}
+_pipeline = None
+_pipeline_lock = threading.Lock()
 
 
 def adjust(what, params):
 
-    global_PVs = pv.init_general_PVs(params)
+    global_PVs = pv.init_general_PVs(params, RESOLUTION_PVS if what == 'resolution' else rotation_pvs(params))
     try: 
         detector_sn = global_PVs['Cam1SerialNumber'].get()
         if ((detector_sn == None) or (detector_sn == 'Unknown')):
@@ -77,6 +102,7 @@ def adjust(what, params):
                         % (params.detector_prefix, detector_sn))
             detector.init(global_PVs, params)
             detector.set(global_PVs, params) 
+            _configure_workspaces(params)
             dark_field, white_field = detector.take_dark_and_white(global_PVs, params)
             if (what == 'resolution' ):
                 find_resolution(params, dark_field, white_field)
@@ -100,26 +126,27 @@ def adjust(what, params):
 
 def find_resolution(params, dark_field, white_field):
 
-    global_PVs = pv.init_general_PVs(params)
+    global_PVs = pv.init_general_PVs(params, RESOLUTION_PVS)
 
     log.warning(' *** Find resolution ***')
     log.info('  *** First image at X: %f mm' % (params.sample_in_x))
     log.info('  *** acquire first image')
 
-    sample_0 = util.normalize(detector.take_image(global_PVs, params), white_field, dark_field)
+    corrector = _flat_field_corrector(dark_field, white_field)
+    sample_0 = corrector.apply(detector.take_image(global_PVs, params))
     
     second_image_x_position = params.sample_in_x + params.off_axis_position
     log.info('  *** Second image at X: %f mm' % (second_image_x_position))
     global_PVs["SampleX"].put(second_image_x_position, wait=True, timeout=600.0)
     log.info('  *** acquire second image')
-    sample_1 = util.normalize(detector.take_image(global_PVs, params), white_field, dark_field)
+    sample_1 = corrector.apply(detector.take_image(global_PVs, params))
        
     log.info('  *** moving X stage back to %f mm position' % (params.sample_in_x))
     pv.move_sample_in(global_PVs, params)
 
-    shift = phase_cross_correlation(sample_0, sample_1, normalization=None, upsample_factor=100)
-    log.info('  *** shift X: %f, Y: %f' % (shift[0][1],shift[0][0]))
-    image_pixel_size =  abs(params.off_axis_position) / np.linalg.norm(shift[0]) * 1000.0
+    shift = register.register(sample_0, sample_1, **_registration_options(params))
+    log.info('  *** shift X: %f, Y: %f' % (shift[1],shift[0]))
+    image_pixel_size =  abs(params.off_axis_position) / np.linalg.norm(shift) * 1000.0
     
     log.warning('  *** found resolution %f μm/pixel' % (image_pixel_size))
     params.image_pixel_size = image_pixel_size
@@ -127,50 +154,418 @@ def find_resolution(params, dark_field, white_field):
     return image_pixel_size
 
 
-def _measure_rotation(params, global_PVs, dark_field, white_field):
+def _registration_options(params, refinement=None, fallback=False):
+    """Keyword arguments for align.register selected by the registration options.
+
+    *refinement* is a (refiner, upsample_factor) pair from
+    register.refinement; None registers at full precision. *fallback*
+    selects the alternative method used to re-register low quality
+    frames: the DFT refiner at full precision with the apodization
+    switched (hann instead of none, none instead of a window).
+    """
+    options = {'pyramid': None,
+               'taper': None if params.registration_taper == 'none' else params.registration_taper,
+               'memory_budget': params.memory_budget * 1024**2 if params.memory_budget > 0 else None,
+               'refiner': 'dft' if params.subpixel_refiner == 'auto' else params.subpixel_refiner,
+               'upsample_factor': 100,
+               'workers': _analysis_workers(params)}
+    if params.registration_mode == 'pyramid':
+        options['pyramid'] = [int(level) for level in params.pyramid_levels.split(',')]
+        options['window'] = params.pyramid_window
+    if refinement is not None:
+        options['refiner'], options['upsample_factor'] = refinement
+    if fallback:
+        options['taper'] = 'hann' if options['taper'] is None else None
+        options['refiner'], options['upsample_factor'] = 'dft', 100
+    return options
+
+
+def _analysis_workers(params):
+    """Number of analysis threads selected by --analysis-workers."""
+    return params.analysis_workers if params.analysis_workers > 0 else (os.cpu_count() or 1)
+
+
+def _configure_workspaces(params):
+    """Bound the cached registration buffers by the cache size and the memory budget."""
+    cache_size = params.workspace_cache_size
+    if params.memory_budget > 0:
+        cache_size = min(cache_size, params.memory_budget)
+    register.set_workspace_cache_size(cache_size * 1024**2)
+
+
+def _flat_field_corrector(dark_field, white_field, binning=1):
+    """util.FlatFieldCorrector for a dark/white pair, built once per pair and binning.
+
+    With binning > 1 the fields are block-binned to match a hardware
+    binned frame.
+    """
+    key = (id(dark_field), id(white_field), binning)
+    if key not in _corrector_cache:
+        _corrector_cache.clear()
+        if binning > 1:
+            corrector = util.FlatFieldCorrector(register.bin_image(white_field, binning)[0],
+                                                register.bin_image(dark_field, binning)[0])
+        else:
+            corrector = util.FlatFieldCorrector(white_field, dark_field)
+        # the fields are kept so their ids are not reused while cached
+        _corrector_cache[key] = (dark_field, white_field, corrector)
+    return _corrector_cache[key][2]
+
+
+def _acquire_rotation(params, global_PVs, dark_field, white_field, binning=1):
+    """Acquire normalized 0°/180° images as RotationFrames.
+
+    Does not move sample Y, log operator settings, or prompt the user.
+    Caller is responsible for positioning sample Y before calling.
+
+    With binning > 1 the detector reads out the full sensor binned
+    binning x binning and the dark and white fields are binned to match.
+    """
+    if params.coarse_binning > 1:
+        detector.set_binning(global_PVs, binning)
+    corrector = _flat_field_corrector(dark_field, white_field, binning)
+    pool = register.analysis_pool(_analysis_workers(params))
+
+    # normalized in the analysis pool while the stage rotates
+    images = {}
+    for angle, image in _take_projections(params, global_PVs, (0, 180)):
+        images[angle] = pool.submit(corrector.apply, image, angle == 180)
+
+    return RotationFrames(sample_0=images[0].result(), sample_180=images[180].result(), binning=binning)
+
+
+def _take_projection(params, global_PVs, angle):
+    """Raw image at rotary stage *angle* (deg)."""
+    log.info('  *** moving rotary stage to %f deg position ***' % float(angle))
+    global_PVs["Rotation"].put(float(angle), wait=True, timeout=600.0)
+    log.error('  ***  *** acquire sample at %f deg position ***' % float(angle))
+    return detector.take_image(global_PVs, params)
+
+
+def _take_projections(params, global_PVs, angles):
+    """Raw images at rotary stage *angles* (deg), yielded as (angle, image) in angle order.
+
+    The angles are taken serpentine: in increasing order, or in
+    decreasing order when the stage is nearer the last angle, as it is
+    after the previous measurement, so no measurement starts with a
+    return to 0 deg. Callers key the images by angle, so the order does
+    not change the results. With --rotation-motion fly the stage does not
+    stop at the angles (see _fly_projections).
+    """
+    angles = _serpentine(global_PVs, angles)
+    if angles[0] > angles[-1]:
+        log.info('  *** taking the angles from %f down to %f deg ***' % (angles[0], angles[-1]))
+    if params.rotation_motion == 'fly':
+        yield from _fly_projections(params, global_PVs, angles)
+        return
+    for angle in angles:
+        yield angle, _take_projection(params, global_PVs, angle)
+
+
+def _serpentine(global_PVs, angles):
+    """*angles* sorted to start from the end nearer the rotary stage position."""
+    angles = sorted(angles)
+    position = global_PVs['RotationRBV'].get()
+    if position is not None and abs(position - angles[-1]) < abs(position - angles[0]):
+        angles.reverse()
+    return angles
+
+
+def _first_angle(params, global_PVs):
+    """Angle (deg) the next rotation measurement starts at, so the stage can be moved there in advance."""
+    if _multi_angle(params):
+        return _serpentine(global_PVs, set(angle for pair in _measurement_pairs(params) for angle in pair))[0]
+    return _serpentine(global_PVs, (0, 180))[0]
+
+
+def _fly_projections(params, global_PVs, angles):
+    """Raw images at sorted *angles* (deg), increasing or decreasing, taken while the rotary stage flies through them.
+
+    The PSO triggers the detector at every multiple of the largest
+    spacing common to all angles, at the rotary stage velocity, so the
+    stage accelerates and settles once per measurement instead of once
+    per angle. Frames at trigger positions that are not in *angles* are
+    read and dropped. Raises RuntimeError if a frame was lost, as the
+    angles of the following frames would then be unknown.
+    """
+    # trigger spacing in millidegrees
+    steps = [int(round(abs(angle - angles[0]) * 1000)) for angle in angles]
+    spacing = int(np.gcd.reduce(steps))
+    wanted = {step // spacing: angle for step, angle in zip(steps, angles)}
+    delta = spacing / 1000.0
+    velocity = global_PVs['RotationVelo'].get()
+    if not velocity or velocity <= 0:
+        raise RuntimeError('  *** rotary stage velocity %s deg/s cannot be used for a fly measurement' % velocity)
+    log.info('  *** flying rotary stage from %f to %f deg at %f deg/s, blur %f deg per frame ***'
+             % (angles[0], angles[-1], velocity, velocity * params.exposure_time))
+
+    num_triggers = pv.setup_fly(global_PVs, angles[0], angles[-1], delta, velocity)
+    timeout = delta / velocity + params.exposure_time + 5
+    count = 0
+    for index, image in enumerate(detector.take_images(global_PVs, params, num_triggers,
+                                                       start=lambda: pv.fly(global_PVs), timeout=timeout)):
+        count += 1
+        if index in wanted:
+            log.error('  ***  *** acquired sample at %f deg position on the fly ***' % wanted[index])
+            yield wanted[index], image
+    pv.wait_fly(global_PVs, timeout)
+    if count < num_triggers:
+        raise RuntimeError('  *** %d of %d fly scan frames were read: use --rotation-motion step'
+                           % (count, num_triggers))
+
+
+def _reacquire_lower_contrast(params, global_PVs, dark_field, white_field, frames):
+    """RotationFrames with the lower contrast of the two projections acquired again."""
+    corrector = _flat_field_corrector(dark_field, white_field, frames.binning)
+    if np.std(frames.sample_0) <= np.std(frames.sample_180):
+        return frames._replace(sample_0=corrector.apply(_take_projection(params, global_PVs, frames.angle)))
+    return frames._replace(sample_180=corrector.apply(_take_projection(params, global_PVs, frames.angle + 180),
+                                                      flip=True))
+
+
+def _analyze_rotation(params, frames, refinement=None, fallback=False):
+    """Register RotationFrames and return rotation axis shifts as a RotationResult.
+
+    *refinement* selects a cheaper sub-pixel refiner (see
+    register.refinement); None registers at full precision. *fallback*
+    selects the alternative registration method (see
+    _registration_options). Shifts of binned frames are scaled back to
+    full resolution pixels.
+    """
+    binning = frames.binning
+    result = register.register_rotation(frames.sample_0, frames.sample_180,
+                                        strip_height=max(params.strip_height // binning, 1),
+                                        strip_count=params.strip_count, mirrored=True,
+                                        **_registration_options(params, refinement, fallback))
+    if binning > 1:
+        log.info('  *** rotation axis measured with %dx%d binning ***' % (binning, binning))
+        result = result._replace(**{field: binning * getattr(result, field) for field in RotationResult._fields[:8]})
+    if refinement is not None and not fallback:
+        log.info('  *** rotation axis registered with %s refinement (upsample factor %d) ***' % refinement)
+
+    log.info('  *** rotation axis shift X: %f pixels ***' % float(result.shift_x))
+    log.info('  *** rotation axis shift X: %f mm ***' % float(result.shift_x * params.image_pixel_size / 1000))
+    log.info('  *** rotation axis shift Y: %f pixels (pitch) ***' % float(result.shift_y))
+    log.info('  *** rotation axis shift Y: %f mm     (pitch) ***' % float(result.shift_y * params.image_pixel_size / 1000))
+    log.info('  *** rotation axis top    %f pixels ***' % float(result.shift_top))
+    log.info('  *** rotation axis center %f pixels ***' % float(result.shift_center))
+    log.info('  *** rotation axis bottom %f pixels ***' % float(result.shift_bottom))
+    log.info('  *** rotation axis tilt   %f pixels (%d strips, residual %f pixels) ***'
+             % (result.tilt, params.strip_count, result.residual))
+    log.info('  *** registration quality: PSR %.1f, peak height %.3f, error %.3f; %d/%d strips above floor ***'
+             % (result.quality.psr, result.quality.peak_height, result.quality.error,
+                sum(_above_floor(params, quality) for quality in result.strip_quality), len(result.strip_quality)))
+
+    return result
+
+
+def _above_floor(params, quality):
+    return quality.psr >= params.psr_floor and quality.peak_height >= params.peak_height_floor
+
+
+def _quality_ok(params, result):
+    """True if the full frame and at least half the strips registered above the quality floors."""
+    strips = sum(_above_floor(params, quality) for quality in result.strip_quality)
+    return _above_floor(params, result.quality) and 2 * strips >= len(result.strip_quality)
+
+
+def _checked_rotation(params, global_PVs, dark_field, white_field, frames, refinement=None, result=None):
+    """Analyze RotationFrames, re-measuring them until the result passes the quality floors.
+
+    A low quality registration is first repeated with the fallback
+    method on the same frames; if that is also below the floors the
+    lower contrast frame is acquired again, at most --quality-retries
+    times. *result* is the RotationResult of the frames if they were
+    already analyzed. Returns the frames and the RotationResult, or
+    raises RegistrationQualityError before the caller can move a motor
+    on it.
+    """
+    if result is None:
+        result = _analyze_rotation(params, frames, refinement)
+    for retry in range(params.quality_retries + 1):
+        if _quality_ok(params, result):
+            return frames, result
+        log.warning('  *** registration below the quality floors (PSR %.1f < %.1f or peak height %.3f < %.3f) '
+                    '— re-registering with the fallback method ***'
+                    % (result.quality.psr, params.psr_floor, result.quality.peak_height, params.peak_height_floor))
+        result = _analyze_rotation(params, frames, refinement, fallback=True)
+        if _quality_ok(params, result):
+            return frames, result
+        if retry == params.quality_retries:
+            break
+        log.warning('  *** re-acquiring the lower contrast frame (%d/%d) ***' % (retry + 1, params.quality_retries))
+        frames = _reacquire_lower_contrast(params, global_PVs, dark_field, white_field, frames)
+        result = _analyze_rotation(params, frames, refinement)
+    for angle, frame in ((frames.angle, frames.sample_0), (frames.angle + 180, frames.sample_180)):
+        _log_sample_location('%g' % angle, util.locate_sample(frame))
+    raise RegistrationQualityError('  *** registration quality stayed below the floors after %d re-acquisitions: '
+                                   'check the sample is in the field of view' % params.quality_retries)
+
+
+def _log_sample_location(name, location):
+    """Log where the sample is in a normalized projection (see util.locate_sample)."""
+    if location.centroid is None:
+        log.warning('  *** no sample found in the %s deg projection' % name)
+        return
+    log.warning('  *** sample in the %s deg projection: centroid (%.1f, %.1f) px, rows %d-%d, columns %d-%d, '
+                'covering %.1f%% of the field of view'
+                % ((name,) + location.centroid + (location.box[0], location.box[2], location.box[1], location.box[3],
+                                                   100 * location.occupancy)))
+
+
+def _measure_rotation(params, global_PVs, dark_field, white_field, binning=1, refinement=None):
     """Acquire 0°/180° images and return rotation axis shifts as a RotationResult.
 
+    In multi-angle mode (see _multi_angle) all --measurement-angles are
+    acquired and the rotation axis is solved from every opposed pair.
+
     Does not move sample Y, log operator settings, or prompt the user.
     Caller is responsible for positioning sample Y before calling.
+    Raises RegistrationQualityError if the registration stays below the
+    quality floors (see _checked_rotation).
+    """
+    measurement = _start_measurement(params, global_PVs, dark_field, white_field, binning, refinement)
+    return _finish_measurement(params, global_PVs, dark_field, white_field, measurement)[1]
+
+
+def _analysis_pipeline():
+    """Single thread executor registering measurements while the caller moves motors.
+
+    Separate from register.analysis_pool, whose threads the registrations
+    themselves use.
+    """
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = ThreadPoolExecutor(max_workers=1, thread_name_prefix='align-pipeline')
+        return _pipeline
+
+
+def _start_measurement(params, global_PVs, dark_field, white_field, binning=1, refinement=None):
+    """Acquire the frames of a rotation measurement and register them in the background.
+
+    Returns as soon as the last frame is read out, with a Measurement
+    whose result is a future, so the caller can move sample Y while the
+    frames are registered. The result is not checked against the quality
+    floors until _finish_measurement.
     """
-    log.info('  *** moving rotary stage to %f deg position ***' % float(0))
-    global_PVs["Rotation"].put(float(0), wait=True, timeout=600.0)
-    log.error('  ***  *** acquire sample at %f deg position ***' % float(0))
-    sample_0 = util.normalize(detector.take_image(global_PVs, params), white_field, dark_field)
-
-    log.info('  *** moving rotary stage to %f deg position ***' % float(180))
-    global_PVs["Rotation"].put(float(180), wait=True, timeout=600.0)
-    log.error('  ***  *** acquire sample at %f deg position ***' % float(180))
-    sample_1 = util.normalize(detector.take_image(global_PVs, params), white_field, dark_field)
-
-    shift0_result = phase_cross_correlation(sample_0, sample_1[:,::-1], normalization=None, upsample_factor=100)[0]
-    shift_x = shift0_result[1] / 2
-    shift_y = shift0_result[0] / 2
-
-    shift_top = phase_cross_correlation(
-        sample_0[:100], sample_1[:100,::-1], normalization=None, upsample_factor=100)[0][1] / 2
-    shift_bottom = phase_cross_correlation(
-        sample_0[-100:], sample_1[-100:,::-1], normalization=None, upsample_factor=100)[0][1] / 2
-    shift_center = phase_cross_correlation(
-        sample_0[sample_0.shape[0]//2-50:sample_0.shape[0]//2+50],
-        sample_1[sample_0.shape[0]//2-50:sample_0.shape[0]//2+50,::-1],
-        normalization=None, upsample_factor=100)[0][1] / 2
-
-    log.info('  *** rotation axis shift X: %f pixels ***' % float(shift_x))
-    log.info('  *** rotation axis shift X: %f mm ***' % float(shift_x * params.image_pixel_size / 1000))
-    log.info('  *** rotation axis shift Y: %f pixels (pitch) ***' % float(shift_y))
-    log.info('  *** rotation axis shift Y: %f mm     (pitch) ***' % float(shift_y * params.image_pixel_size / 1000))
-    log.info('  *** rotation axis top    %f pixels ***' % float(shift_top))
-    log.info('  *** rotation axis center %f pixels ***' % float(shift_center))
-    log.info('  *** rotation axis bottom %f pixels ***' % float(shift_bottom))
-
-    return RotationResult(shift_x=shift_x, shift_y=shift_y,
-                          shift_top=shift_top, shift_center=shift_center, shift_bottom=shift_bottom)
+    sample_y = global_PVs['SampleY'].get()
+    if _multi_angle(params):
+        pairs = _acquire_pairs(params, global_PVs, dark_field, white_field, binning)
+        result = _analysis_pipeline().submit(
+            lambda: [_analyze_rotation(params, frames, refinement) for frames in pairs])
+        return Measurement(pairs, refinement, result, sample_y)
+    frames = _acquire_rotation(params, global_PVs, dark_field, white_field, binning)
+    result = _analysis_pipeline().submit(_analyze_rotation, params, frames, refinement)
+    return Measurement(frames, refinement, result, sample_y)
+
+
+def _finish_measurement(params, global_PVs, dark_field, white_field, measurement):
+    """Wait for a Measurement and check it against the quality floors.
+
+    If a frame has to be acquired again (see _checked_rotation), sample Y
+    is moved back to where the measurement was taken for it and returned
+    afterwards. Returns the frames and the RotationResult.
+    """
+    results = measurement.result.result()
+    if isinstance(measurement.frames, RotationFrames):
+        results = [results]
+    sample_y = global_PVs['SampleY'].get()
+    moved = (not all(_quality_ok(params, result) for result in results)
+             and abs(sample_y - measurement.sample_y) > pv.EPSILON / 100)
+    if moved:
+        log.warning('  *** low quality measurement: moving sample Y back to %f mm to re-measure it ***'
+                    % measurement.sample_y)
+        pv.move_sample_y(global_PVs, measurement.sample_y)
+    try:
+        if isinstance(measurement.frames, RotationFrames):
+            return _checked_rotation(params, global_PVs, dark_field, white_field, measurement.frames,
+                                     measurement.refinement, results[0])
+        return _checked_axis(params, global_PVs, dark_field, white_field, measurement.frames,
+                             measurement.refinement, results)
+    finally:
+        if moved:
+            pv.move_sample_y(global_PVs, sample_y)
+
+
+def _measurement_pairs(params):
+    """(angle, angle + 180) pairs of the --measurement-angles."""
+    angles = [float(angle) for angle in params.measurement_angles.split(',')]
+    pairs = register.opposed_pairs(angles)
+    if not pairs:
+        raise ValueError('--measurement-angles %s has no pair of angles 180 deg apart' % params.measurement_angles)
+    return pairs
+
+
+def _multi_angle(params):
+    """True if --measurement-angles has more than one opposed pair."""
+    return len(_measurement_pairs(params)) > 1
+
+
+def _acquire_pairs(params, global_PVs, dark_field, white_field, binning=1):
+    """Acquire normalized images at all --measurement-angles as a tuple of RotationFrames.
+
+    The projections are taken from the end of the angle range nearer
+    the rotary stage, so the stage turns through the angles once (see
+    _take_projections), and normalized in the analysis pool while the
+    stage moves. There is one RotationFrames per opposed pair (see
+    register.opposed_pairs).
+    """
+    pairs = _measurement_pairs(params)
+    if params.coarse_binning > 1:
+        detector.set_binning(global_PVs, binning)
+    corrector = _flat_field_corrector(dark_field, white_field, binning)
+    pool = register.analysis_pool(_analysis_workers(params))
+
+    second = set(other for _, other in pairs)
+    images = {}
+    for angle, image in _take_projections(params, global_PVs, set(angle for pair in pairs for angle in pair)):
+        images[angle] = pool.submit(corrector.apply, image, angle in second)
+
+    return tuple(RotationFrames(sample_0=images[angle].result(), sample_180=images[other].result(),
+                                binning=binning, angle=angle)
+                 for angle, other in pairs)
+
+
+def _analyze_axis(params, pairs, refinement=None):
+    """Register a tuple of RotationFrames and return the least squares rotation axis as a RotationResult.
+
+    See register.solve_rotation_axis.
+    """
+    return _solve_axis(params, pairs, [_analyze_rotation(params, frames, refinement) for frames in pairs])
+
+
+def _checked_axis(params, global_PVs, dark_field, white_field, pairs, refinement=None, results=None):
+    """Multi-angle version of _checked_rotation.
+
+    Every pair is checked against the quality floors before the rotation
+    axis is solved. *results* are the RotationResults of the pairs if
+    they were already analyzed. Returns the pairs and the solved
+    RotationResult.
+    """
+    checked = [_checked_rotation(params, global_PVs, dark_field, white_field, frames, refinement, result)
+               for frames, result in zip(pairs, results or [None] * len(pairs))]
+    pairs = tuple(frames for frames, _ in checked)
+    return pairs, _solve_axis(params, pairs, [result for _, result in checked])
+
+
+def _solve_axis(params, pairs, results):
+    result, shift_y_90 = register.solve_rotation_axis([frames.angle for frames in pairs], results)
+    log.info('  *** rotation axis from %d pairs (%s deg): shift X %f, center %f, tilt %f, '
+             'shift Y %f (pitch), shift Y at 90 deg %f pixels, residual %f pixels ***'
+             % (len(pairs), ', '.join('%g/%g' % (frames.angle, frames.angle + 180) for frames in pairs),
+                result.shift_x, result.shift_center, result.tilt, result.shift_y, shift_y_90, result.residual))
+    return result
+
+
+def rotation_pvs(params):
+    """ROTATION_PVS, with the PSO fly scan PVs in fly mode."""
+    return ROTATION_PVS + (pv.FLY_PVS if params.rotation_motion == 'fly' else ())
 
 
 def find_rotation_axis(params, dark_field, white_field):
 
-    global_PVs = pv.init_general_PVs(params)
+    global_PVs = pv.init_general_PVs(params, rotation_pvs(params))
 
     camera_select = global_PVs['CameraSelect'].get(as_string=True)
     if camera_select == 'Camera 1':
@@ -194,18 +589,21 @@ def find_rotation_axis(params, dark_field, white_field):
     log.info('  *** Focus position:    %f mm'  % focus_position)
 
     log.warning(' *** Aligning rotation ***')
-    result = _measure_rotation(params, global_PVs, dark_field, white_field)
+    if _multi_angle(params):
+        pairs = _acquire_pairs(params, global_PVs, dark_field, white_field)
+        _log_sample_location('%g' % pairs[0].angle, util.locate_sample(pairs[0].sample_0))
+        result = _checked_axis(params, global_PVs, dark_field, white_field, pairs)[1]
+    else:
+        frames = _acquire_rotation(params, global_PVs, dark_field, white_field)
+        _log_sample_location('0', util.locate_sample(frames.sample_0))
+        result = _checked_rotation(params, global_PVs, dark_field, white_field, frames)[1]
 
     log.info('  *** Move rotation axis to %f mm ?' % float(global_PVs["SampleX"].get() + result.shift_x * params.image_pixel_size / 1000))
     log.info('  *** Move rotation axis to %f pixels ?' % float(global_PVs["SampleX"].get() + result.shift_x))
     if(params.ask):
         if util.yes_or_no('   *** Yes or No'):
             global_PVs["SampleX"].put(global_PVs["SampleX"].get() + result.shift_x * params.image_pixel_size / 1000, wait=True, timeout=600.0)
-            global_PVs["SampleXSet"].put(1, wait=True)
-            time.sleep(.2)
-            global_PVs["SampleX"].put(0, wait=True)
-            time.sleep(.2)
-            global_PVs["SampleXSet"].put(0, wait=True)
+            pv.zero_sample_x(global_PVs)
         else:
             log.warning(' No motion ')
             exit()
@@ -51,26 +51,187 @@ import numexpr as ne
 import argparse
 import numpy as np
 
+from collections import namedtuple
 from skimage import filters
-from skimage.measure import regionprops
 
 from align import log
 
+FlatFieldCheck = namedtuple('FlatFieldCheck', ['valid', 'occupancy', 'nonuniformity', 'deviation'])
+SampleLocation = namedtuple('SampleLocation', ['threshold', 'centroid', 'box', 'occupancy'])
+
+SHADOW_LEVEL = 0.5
+REFERENCE_TOLERANCE = 0.1
+BEAM_FLOOR = 0.05
+PROFILE_TILES = 8
+
+
+def locate_sample(image, subsample=4):
+    """
+    Locate the sample, the pixels darker than the Otsu threshold, in a projection.
+
+    The threshold is taken from the histogram of a subsampled copy of
+    the image; the sample pixels, weighted by their intensity, are then
+    reduced to row and column moment sums from which the centroid and
+    the bounding box follow without labelling the image.
+
+    Parameters
+    ----------
+    image : ndarray
+        2D uint16 or float32 projection.
+    subsample : int, optional
+        Step between the rows and columns used for the histogram.
+
+    Returns
+    -------
+    SampleLocation
+        threshold, intensity weighted (row, col) centroid, bounding box
+        (min_row, min_col, max_row, max_col) as in skimage regionprops and
+        occupancy, the fraction of the image covered by the sample.
+        centroid and box are None if no pixel is below the threshold.
+    """
+    threshold = filters.threshold_otsu(image[::subsample, ::subsample])
+    if image.dtype == np.float32 or image.dtype == np.float64:
+        t = image.dtype.type(threshold)
+        weights = ne.evaluate('where(image<t,image,0)').astype(np.float32, copy=False)
+    else:
+        weights = np.multiply(image, image < threshold, dtype=np.float32)
+
+    nrows, ncols = weights.shape
+    row_weights = weights @ np.ones(ncols, dtype=np.float32)
+    col_weights = np.ones(nrows, dtype=np.float32) @ weights
+    occupancy = float(np.count_nonzero(weights)) / weights.size
+    threshold = float(threshold)
+    total = row_weights.sum(dtype=np.float64)
+    if total <= 0:
+        return SampleLocation(threshold=threshold, centroid=None, box=None, occupancy=occupancy)
+
+    centroid = (float(np.arange(nrows) @ row_weights.astype(np.float64) / total),
+                float(np.arange(ncols) @ col_weights.astype(np.float64) / total))
+    rows = np.flatnonzero(row_weights)
+    cols = np.flatnonzero(col_weights)
+    box = (int(rows[0]), int(cols[0]), int(rows[-1]) + 1, int(cols[-1]) + 1)
+    return SampleLocation(threshold=threshold, centroid=centroid, box=box, occupancy=occupancy)
+
 
 def center_of_mass(image):
-    
-    threshold_value = filters.threshold_otsu(image)
-    log.info("  ***  *** threshold_value: %f" % (threshold_value))
-    labeled_foreground = (image < threshold_value).astype(int)
-    properties = regionprops(labeled_foreground, image)
-    return properties[0].weighted_centroid
-    #return properties[0].centroid
+
+    location = locate_sample(image)
+    log.info("  ***  *** threshold_value: %f" % (location.threshold))
+    return location.centroid
+
+
+class RunningStatistics(object):
+    """Per-pixel mean and variance of a stream of frames.
+
+    Welford's update keeps the running mean and the sum of squared
+    deviations from it, so memory does not grow with the number of
+    frames and the variance does not suffer from the cancellation of
+    the sum of squares formula.
+
+    Parameters
+    ----------
+    shape : tuple
+        Frame shape.
+    """
+
+    def __init__(self, shape):
+        self.count = 0
+        self.mean = np.zeros(shape, dtype=np.float32)
+        self._m2 = np.zeros(shape, dtype=np.float32)
+        self._frame = np.empty(shape, dtype=np.float32)
+        self._delta = np.empty(shape, dtype=np.float32)
+
+    def add(self, frame):
+        """Update the statistics with *frame*."""
+        self.count += 1
+        n = np.float32(self.count)
+        np.copyto(self._frame, frame)
+        frame, mean, delta, m2 = self._frame, self.mean, self._delta, self._m2
+        ne.evaluate('frame - mean', out=delta)
+        ne.evaluate('mean + delta / n', out=mean)
+        ne.evaluate('m2 + delta * (frame - mean)', out=m2)
+
+    @property
+    def variance(self):
+        """Unbiased per-pixel variance (zero for fewer than two frames)."""
+        if self.count < 2:
+            return np.zeros_like(self._m2)
+        return self._m2 / np.float32(self.count - 1)
+
+    @property
+    def std(self):
+        """Per-pixel standard deviation."""
+        return np.sqrt(self.variance)
+
+
+class FlatFieldCorrector(object):
+    """
+    Flat and dark field correction precomputed for one dark/white pair.
+
+    The dark offset and the reciprocal gain 1 / (flat - dark) are
+    computed once, so each frame costs one fused numexpr pass that casts,
+    dark subtracts, scales and clips it into the output buffer.
+
+    Parameters
+    ----------
+    flat : ndarray
+        2D flat field data.
+    dark : ndarray
+        2D dark field data.
+    cutoff : float, optional
+        Permitted maximum vaue for the normalized data.
+    """
+
+    def __init__(self, flat, dark, cutoff=None):
+        l = np.float32(1e-5)
+        self.dark = np.array(dark, dtype=np.float32)
+        flat = np.asarray(flat, dtype=np.float32)
+        dark = self.dark
+        self.gain = ne.evaluate('flat-dark')
+        ne.evaluate('1/where(gain<l,l,gain)', local_dict={'gain': self.gain, 'l': l}, out=self.gain, truediv=True)
+        self.cutoff = None if cutoff is None else np.float32(cutoff)
+        self.shape = self.dark.shape
+
+    def apply(self, arr, flip=False, out=None):
+        """
+        Normalize a raw projection.
+
+        Parameters
+        ----------
+        arr : ndarray
+            2D raw projection, e.g. uint16 straight from the detector.
+        flip : bool, optional
+            Return the normalized projection flipped horizontally, as
+            needed for the 180 deg projection of a rotation measurement.
+        out : ndarray, optional
+            float32 output array for the result. If same as a float32
+            arr, process will be done in-place.
+
+        Returns
+        -------
+        ndarray
+            Normalized float32 projection.
+        """
+        dark, gain = self.dark, self.gain
+        if flip:
+            arr, dark, gain = arr[:, ::-1], dark[:, ::-1], gain[:, ::-1]
+        if out is None:
+            out = np.empty(arr.shape, dtype=np.float32)
+        if self.cutoff is None:
+            ne.evaluate('(arr-dark)*gain', out=out)
+        else:
+            cutoff = self.cutoff
+            ne.evaluate('where((arr-dark)*gain>cutoff,cutoff,(arr-dark)*gain)', out=out)
+        return out
 
 
 def normalize(arr, flat, dark, cutoff=None, out=None):
     """
     Normalize raw projection data using the flat and dark field projections.
 
+    Builds a FlatFieldCorrector for a single projection; use one
+    directly to correct several projections with the same fields.
+
     Parameters
     ----------
     arr : ndarray
@@ -90,24 +251,110 @@ def normalize(arr, flat, dark, cutoff=None, out=None):
     ndarray
         Normalized 2D tomographic data.
     """
-    arr = arr.astype('float32')
-    l = np.float32(1e-5)
     log.info('  ***  *** image size: [%d, %d]' % (flat.shape[0], flat.shape[1]))
-    # flat = np.mean(flat, axis=0, dtype=np.float32)
-    # dark = np.mean(dark, axis=0, dtype=np.float32)
-    flat = flat.astype('float32')
-    dark = dark.astype('float32')
-
-    denom = ne.evaluate('flat')
-    # denom = ne.evaluate('flat-dark')
-    ne.evaluate('where(denom<l,l,denom)', out=denom)
-    out = ne.evaluate('arr', out=out)
-    # out = ne.evaluate('arr-dark', out=out)
-    ne.evaluate('out/denom', out=out, truediv=True)
-    if cutoff is not None:
-        cutoff = np.float32(cutoff)
-        ne.evaluate('where(out>cutoff,cutoff,out)', out=out)
-    return out
+    return FlatFieldCorrector(flat, dark, cutoff).apply(arr, out=out)
+
+
+def check_flat_field(white, dark, reference=None, max_occupancy=0.01, max_nonuniformity=0.5, max_deviation=0.02):
+    """
+    Check that a white field shows the open beam, with no sample in it.
+
+    Occupancy and nonuniformity are measured against the open beam
+    background, so a beam that falls off towards the edges of the field
+    is not mistaken for a shadow. The background is the intensity scaled
+    reference when one is usable, and otherwise the beam profile of
+    beam_profile. Pixels where the background is below BEAM_FLOOR times
+    the open beam level are outside the beam and not tested.
+
+    Parameters
+    ----------
+    white : ndarray
+        2D white field.
+    dark : ndarray
+        2D dark field.
+    reference : ndarray, optional
+        Dark subtracted white field of a previous valid acquisition.
+        Ignored if its shape differs (e.g. after a binning change).
+    max_occupancy : float, optional
+        Largest fraction of pixels allowed below SHADOW_LEVEL times the
+        background, i.e. shadowed by the sample.
+    max_nonuniformity : float, optional
+        Largest coefficient of variation allowed for the white field
+        divided by the background.
+    max_deviation : float, optional
+        Largest fraction of pixels allowed to differ by more than
+        REFERENCE_TOLERANCE from the intensity scaled reference.
+
+    Returns
+    -------
+    FlatFieldCheck
+        valid, the fraction of occupied pixels, the coefficient of
+        variation and the fraction of pixels deviating from the
+        reference (None without a usable reference).
+    """
+    signal = np.subtract(white, dark, dtype=np.float32)
+    level = np.float32(np.percentile(signal[::4, ::4], 99))
+
+    usable = reference is not None and reference.shape == signal.shape
+    if usable:
+        sub = reference[::4, ::4]
+        inside = sub > BEAM_FLOOR * np.percentile(sub, 99)
+        ratio = np.median(signal[::4, ::4][inside] / sub[inside]) if inside.any() else 1
+        background = np.float32(ratio) * reference.astype(np.float32, copy=False)
+    else:
+        background = beam_profile(signal)
+    floor = np.float32(BEAM_FLOOR) * level
+    beam = background > floor
+
+    deviation = None
+    if usable:
+        tolerance = np.float32(REFERENCE_TOLERANCE)
+        deviation = float(ne.evaluate('sum(where(beam & (abs(signal - background) > tolerance * background), 1, 0))')) / signal.size
+
+    shadow = np.float32(SHADOW_LEVEL)
+    occupancy = float(ne.evaluate('sum(where(beam & (signal < shadow * background), 1, 0))')) / signal.size
+    relative = ne.evaluate('signal / background')[beam]
+    mean = relative.mean(dtype=np.float64) if relative.size else 0
+    nonuniformity = float(relative.std(dtype=np.float64) / mean) if mean > 0 else np.inf
+
+    valid = (occupancy <= max_occupancy and nonuniformity <= max_nonuniformity and
+             (deviation is None or deviation <= max_deviation))
+    return FlatFieldCheck(valid=valid, occupancy=occupancy, nonuniformity=nonuniformity, deviation=deviation)
+
+
+def beam_profile(signal, tiles=PROFILE_TILES):
+    """
+    Smooth open beam profile of a dark subtracted white field.
+
+    The field is cut in tiles x tiles tiles; the median of each tile,
+    taken on a 4x4 subsample, is its open beam level, and the levels are
+    interpolated bilinearly between the tile centres. A shadow covering
+    less than half of a tile does not lower the profile.
+
+    Parameters
+    ----------
+    signal : ndarray
+        2D dark subtracted white field.
+    tiles : int, optional
+        Number of tiles along each axis.
+
+    Returns
+    -------
+    ndarray
+        float32 beam profile, the shape of *signal*.
+    """
+    rows = np.array_split(np.arange(signal.shape[0]), tiles)
+    cols = np.array_split(np.arange(signal.shape[1]), tiles)
+    levels = np.array([[np.median(signal[r[0]:r[-1] + 1:4, c[0]:c[-1] + 1:4]) for c in cols]
+                       for r in rows], dtype=np.float32)
+
+    def interpolation(n, parts):
+        # (n, tiles) weights of the tile centres at every pixel along one axis
+        centres = [part.mean() for part in parts]
+        return np.stack([np.interp(np.arange(n), centres, np.eye(tiles)[i]) for i in range(tiles)],
+                        axis=1).astype(np.float32)
+
+    return interpolation(signal.shape[0], rows) @ levels @ interpolation(signal.shape[1], cols).T
 
 
 def yes_or_no(question):
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from align import detector
+
+SHAPE = (6, 10)
+
+
+def pack_mono12packed(image):
+    """GigE Vision Mono12Packed, bit by bit: pixel 0 bits 11-4, the two low nibbles, pixel 1 bits 11-4."""
+    even, odd = image.reshape(-1, 2).T.astype(np.uint16)
+    return np.stack([even >> 4, (odd & 0x0F) << 4 | (even & 0x0F), odd >> 4], axis=1).astype(np.uint8).ravel()
+
+
+def pack_mono12p(image):
+    """GenICam Mono12p: the 24 bits of two pixels, least significant bit first."""
+    even, odd = image.reshape(-1, 2).T.astype(np.uint32)
+    bits = even | odd << 12
+    return np.stack([bits & 0xFF, bits >> 8 & 0xFF, bits >> 16], axis=1).astype(np.uint8).ravel()
+
+
+def ca_array(data, dtype):
+    """The image plugin array as CA delivers it: signed, and longer than the frame."""
+    return np.concatenate([data, np.zeros(7, dtype=data.dtype)]).view(dtype)
+
+
+@pytest.mark.parametrize('pixel_format, pack', [('Mono12Packed', pack_mono12packed), ('Mono12p', pack_mono12p)])
+def test_packed_formats_round_trip(pixel_format, pack):
+    image = np.random.default_rng(0).integers(0, 4096, SHAPE, dtype=np.uint16)
+    image[0, :4] = (0, 4095, 0x0F0, 0xF0F)
+    raw = ca_array(pack(image), np.int8)
+    decoded = detector.decode_image(raw, *SHAPE, pixel_format, packed=True)
+    assert decoded.dtype == np.uint16
+    np.testing.assert_array_equal(decoded, image)
+
+
+@pytest.mark.parametrize('pixel_format, dtype', [('Mono8', np.uint8), ('Mono12', np.uint16), ('Mono16', np.uint16)])
+def test_unpacked_formats_are_unsigned_views(pixel_format, dtype):
+    image = np.random.default_rng(1).integers(0, np.iinfo(dtype).max, SHAPE, dtype=dtype, endpoint=True)
+    raw = ca_array(image.ravel(), np.dtype(dtype).str.replace('u', 'i'))
+    decoded = detector.decode_image(raw, *SHAPE, pixel_format)
+    assert decoded.dtype == dtype
+    assert np.shares_memory(decoded, raw)
+    np.testing.assert_array_equal(decoded, image)
+
+
+def test_unknown_pixel_format_is_rejected():
+    with pytest.raises(RuntimeError):
+        detector.decode_image(np.zeros(60, dtype=np.int16), *SHAPE, 'RGB8')
@@ -0,0 +1,104 @@
+import types
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from align import config
+from align import register
+from align import sample
+
+SHAPE = (512, 612)
+SHIFT_X = -3.2
+FLOORS = types.SimpleNamespace(psr_floor=config.SECTIONS['registration']['psr-floor']['default'],
+                               peak_height_floor=config.SECTIONS['registration']['peak-height-floor']['default'])
+
+
+def fourier_shift(image, shift):
+    ky = np.fft.fftfreq(image.shape[0])[:, None]
+    kx = np.fft.fftfreq(image.shape[1])[None, :]
+    return np.fft.ifft2(np.fft.fft2(image) * np.exp(-2j * np.pi * (ky * shift[0] + kx * shift[1]))).real
+
+
+def textured_sample(rng, kind):
+    """Attenuation of a textured cylinder (even kind) or ellipsoid (odd kind) in the middle of the field."""
+    nrows, ncols = SHAPE
+    y, x = np.mgrid[:nrows, :ncols]
+    texture = ndimage.gaussian_filter(rng.standard_normal(SHAPE), (1.5, 3, 2, 2.5)[kind])
+    texture = (texture - texture.min()) / np.ptp(texture)
+    radius = (0.3, 0.2, 0.35, 0.25)[kind] * ncols
+    if kind % 2:
+        inside = ((x - ncols / 2) / radius) ** 2 + ((y - nrows / 2) / (0.45 * nrows)) ** 2 < 1
+    else:
+        inside = np.abs(x - ncols / 2) < radius
+    return inside * (0.3 + 0.7 * texture)
+
+
+def normalized_pair(rng, attenuation, noise=0.02):
+    """Flat field normalized 0 and 180 deg projections of a rotation axis SHIFT_X px off center."""
+    projection = np.exp(-attenuation)
+    mirrored = fourier_shift(projection, (0, -2 * SHIFT_X))[:, ::-1]
+    return tuple((image + noise * rng.standard_normal(SHAPE)).astype(np.float32) for image in (projection, mirrored))
+
+
+@pytest.mark.parametrize('kind', range(4))
+def test_textured_samples_pass_the_default_floors(kind):
+    rng = np.random.default_rng(kind)
+    result = register.register_rotation(*normalized_pair(rng, textured_sample(rng, kind)))
+    assert result.shift_x == pytest.approx(SHIFT_X, abs=0.05)
+    assert sample._quality_ok(FLOORS, result)
+
+
+@pytest.mark.parametrize('taper', [None, 'hann'])
+@pytest.mark.parametrize('pair', ['empty', 'noise'])
+def test_uncorrelated_frames_fail_the_default_floors(pair, taper):
+    rng = np.random.default_rng(10)
+    for _ in range(5):
+        if pair == 'empty':
+            images = normalized_pair(rng, np.zeros(SHAPE))
+        else:
+            images = tuple(rng.standard_normal(SHAPE).astype(np.float32) for _ in range(2))
+        result = register.register_rotation(*images, taper=taper)
+        assert np.isfinite(result.quality.psr)
+        assert result.quality.psr < FLOORS.psr_floor
+        assert all(quality.psr < FLOORS.psr_floor for quality in result.strip_quality)
+        assert not sample._quality_ok(FLOORS, result)
+
+
+SHIFTS = [(0, 0), (3.2, -1.7), (-12.45, 7.31), (0.5, 20.25)]
+
+
+def textured_image(rng, shape=(128, 160)):
+    return ndimage.gaussian_filter(rng.standard_normal(shape), 2).astype(np.float32)
+
+
+@pytest.mark.parametrize('shift', SHIFTS)
+def test_register_matches_phase_cross_correlation(shift):
+    skimage_registration = pytest.importorskip('skimage.registration')
+    rng = np.random.default_rng(0)
+    reference = textured_image(rng)
+    moving = fourier_shift(reference, shift).astype(np.float32)
+    expected = skimage_registration.phase_cross_correlation(reference, moving, upsample_factor=100,
+                                                            normalization=None)[0]
+    np.testing.assert_allclose(register.register(reference, moving, upsample_factor=100), expected, atol=0.011)
+    np.testing.assert_allclose(expected, [-value for value in shift], atol=0.05)
+
+
+@pytest.mark.parametrize('refiner', register.REFINERS)
+def test_register_spectra_registers_each_band(refiner):
+    skimage_registration = pytest.importorskip('skimage.registration')
+    rng = np.random.default_rng(1)
+    reference = np.stack([textured_image(rng) for _ in SHIFTS])
+    moving = np.stack([fourier_shift(band, shift) for band, shift in zip(reference, SHIFTS)]).astype(np.float32)
+    shifts = register.register_spectra(register.spectra(reference), register.spectra(moving), 100, refiner=refiner)
+    for band, (ref, mov) in enumerate(zip(reference, moving)):
+        expected = skimage_registration.phase_cross_correlation(ref, mov, upsample_factor=100, normalization=None)[0]
+        np.testing.assert_allclose(shifts[band], expected, atol=0.011 if refiner == 'dft' else 0.1)
+
+
+def test_register_pyramid_finds_large_shifts():
+    rng = np.random.default_rng(2)
+    reference = textured_image(rng, (512, 640))
+    moving = fourier_shift(reference, (-40.3, 95.6)).astype(np.float32)
+    np.testing.assert_allclose(register.register(reference, moving, pyramid=(4, 2), window=256), (40.3, -95.6),
+                               atol=0.05)
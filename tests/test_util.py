@@ -0,0 +1,23 @@
+import numpy as np
+
+from align import util
+
+
+def test_running_statistics_match_numpy():
+    rng = np.random.default_rng(0)
+    frames = rng.normal(30000, 40, (25, 32, 48)).astype(np.uint16)
+    stats = util.RunningStatistics(frames.shape[1:])
+    for frame in frames:
+        stats.add(frame)
+    assert stats.count == len(frames)
+    np.testing.assert_allclose(stats.mean, frames.mean(axis=0), rtol=1e-6)
+    np.testing.assert_allclose(stats.variance, frames.var(axis=0, ddof=1), rtol=1e-3)
+    np.testing.assert_allclose(stats.std, frames.std(axis=0, ddof=1), rtol=1e-3)
+
+
+def test_running_statistics_of_one_frame():
+    stats = util.RunningStatistics((4, 5))
+    frame = np.arange(20, dtype=np.uint16).reshape(4, 5)
+    stats.add(frame)
+    np.testing.assert_array_equal(stats.mean, frame)
+    np.testing.assert_array_equal(stats.variance, 0)